@@ -11,57 +11,224 @@ import libzjsn
 
 from concurrent.futures import ThreadPoolExecutor
 from contextlib import closing
-from queue import Queue
-from threading import Thread
+from queue import Empty, Queue
+from threading import Lock, Thread
 
 FLAG_LOG_RAW = False
 
-fetchedLogs = Queue()
+# Fetchers block once this many results wait for the writer.
+QUEUE_SIZE = 1000
+# The writer commits up to this many fetch results in one transaction...
+WRITE_BATCH_SIZE = 200
+# ...waiting at most this many seconds after the first one arrived.
+WRITE_BATCH_LATENCY = 1.0
+
+# Bounds of the per-server polling interval in seconds.
+MIN_FETCH_PERIOD = 1
+MAX_FETCH_PERIOD = 60
+# Upper bound on log requests per second over all servers together.
+REQUEST_BUDGET = 4.0
+# Number of log entries kept from every response.
+LOG_WINDOW = 30
+
+SERVER_IDS = [2, 3, 4, 5, 6, 7, 8, 9, 10, 11, 12, 13, 14]
+
+fetchedLogs = Queue(QUEUE_SIZE)
+
+logDecoder = libzjsn.DictDecoder()
+
+class RawLogDecoder:
+  '''Saves the inflated response to fileName before handing it to decoder.'''
+
+  def __init__(self, fileName, decoder):
+    self.fileName = fileName
+    self.decoder = decoder
+
+  def decode(self, data):
+    with open(self.fileName, 'wb') as f:
+      f.write(data)
+    return self.decoder.decode(data)
+
+# Highest log ID committed to the database, per (server, category).
+highWaterMarks = {}
+# Highest log ID handed to the writer, per (server, category); it may not be committed yet.
+pendingMarks = {}
+highWaterMarksLock = Lock()
 
 def createDb(name):
   conn = sqlite3.connect(name)
   with closing(conn):
     with conn:
       conn.execute('CREATE TABLE IF NOT EXISTS build_results (server INTEGER NOT NULL, ID INTEGER NOT NULL, UID INTEGER NOT NULL, username STRING NOT NULL, time INTEGER NOT NULL, CID INTEGER NOT NULL, type INTEGER NOT NULL, oil INTEGER NOT NULL, ammo INTEGER NOT NULL, steel INTEGER NOT NULL, aluminium INTEGER NOT NULL, CONSTRAINT primary_key PRIMARY KEY (server, ID) ON CONFLICT IGNORE );')
+      conn.execute('CREATE TABLE IF NOT EXISTS fetch_gaps (server INTEGER NOT NULL, category STRING NOT NULL, time INTEGER NOT NULL, after_id INTEGER NOT NULL, before_id INTEGER NOT NULL);')
 
-def insert(conn, entries):
+def insert(conn, entries, gaps = ()):
   with conn:
+    if gaps:
+      conn.executemany('INSERT INTO fetch_gaps (server, category, time, after_id, before_id) VALUES (?,?,?,?,?);', gaps)
     return conn.executemany('INSERT OR IGNORE INTO build_results (server, ID, UID, username, time, CID, type, oil, ammo, steel, aluminium) VALUES (?,?,?,?,?,?,?,?,?,?,?);', entries).rowcount
 
+def loadHighWaterMarks(dbName, category, serverIds):
+  conn = sqlite3.connect(dbName)
+  with closing(conn):
+    for serverId in serverIds:
+      # One primary key search per server; GROUP BY server would scan the whole index.
+      maxId, = conn.execute('SELECT MAX(ID) FROM build_results WHERE server = ?;', (serverId,)).fetchone()
+      if maxId is not None:
+        highWaterMarks[(serverId, category)] = maxId
+
+def filterNewEntries(serverId, category, entries):
+  '''Drops entries at or below the pending high-water mark and raises that mark.
+
+  Returns: (new entries, gap). gap is (mark, lowest new ID) if none of the entries had been seen
+  before, meaning entries in between may have been missed; None otherwise.'''
+  key = (serverId, category)
+  gap = None
+  with highWaterMarksLock:
+    mark = pendingMarks.get(key, highWaterMarks.get(key))
+    if mark is None:
+      newEntries = list(entries)
+    else:
+      newEntries = [entry for entry in entries if entry[1] > mark]
+      if newEntries and len(newEntries) == len(entries):
+        gap = (mark, min(entry[1] for entry in newEntries))
+    if newEntries:
+      pendingMarks[key] = max(entry[1] for entry in newEntries)
+  return (newEntries, gap)
+
+def settleHighWaterMarks(batch, committed):
+  '''Raises the committed marks after the writer committed batch. If it failed, the pending marks fall
+  back to the committed ones, so the next fetches return the lost entries again.'''
+  with highWaterMarksLock:
+    for serverId, category, timestamp, items, gap in batch:
+      if not items:
+        continue
+      key = (serverId, category)
+      if committed:
+        highWaterMarks[key] = max(highWaterMarks.get(key, 0), max(entry[1] for entry in items))
+      elif key in highWaterMarks:
+        pendingMarks[key] = highWaterMarks[key]
+      else:
+        pendingMarks.pop(key, None)
+
+class RequestBudget:
+  '''Token bucket shared by all fetchers.'''
+
+  def __init__(self, rate, burst = None):
+    self.rate = rate
+    self.burst = burst if burst else rate
+    self._tokens = self.burst
+    self._lastTime = time.monotonic()
+    self._lock = Lock()
+
+  def take(self):
+    '''Takes a token if one is available. Returns: 0 if it did, otherwise seconds until one is.'''
+    with self._lock:
+      now = time.monotonic()
+      self._tokens = min(self.burst, self._tokens + (now - self._lastTime) * self.rate)
+      self._lastTime = now
+      if self._tokens >= 1:
+        self._tokens -= 1
+        return 0
+      return (1 - self._tokens) / self.rate
+
+class AdaptivePoller:
+  '''Chooses the polling interval of one server.
+
+  The arrival rate is estimated from the createTime span of every returned window. The interval aims
+  at half a window of new entries per poll. It is halved when a gap was detected and backs off when
+  nothing new arrived.'''
+
+  def __init__(self, period, minPeriod = MIN_FETCH_PERIOD, maxPeriod = MAX_FETCH_PERIOD, window = LOG_WINDOW):
+    self.period = period
+    self.minPeriod = minPeriod
+    self.maxPeriod = maxPeriod
+    self.window = window
+    self.rate = None
+    self._lock = Lock()
+
+  def observe(self, entries, numNew, gap):
+    times = [entry[4] for entry in entries]
+    with self._lock:
+      if len(times) >= 2 and max(times) > min(times):
+        sample = (len(times) - 1) / (max(times) - min(times))
+        self.rate = sample if self.rate is None else 0.7 * self.rate + 0.3 * sample
+      if gap:
+        period = self.period / 2
+      elif numNew == 0:
+        period = self.period * 1.5
+      elif self.rate:
+        period = self.window / 2 / self.rate
+      else:
+        period = self.period
+      self.period = min(self.maxPeriod, max(self.minPeriod, period))
+      return self.period
+
+requestBudget = RequestBudget(REQUEST_BUDGET)
+
+def takeBatch(queue, maxItems, maxLatency):
+  items = [queue.get()]
+  deadline = time.monotonic() + maxLatency
+  while len(items) < maxItems:
+    remaining = deadline - time.monotonic()
+    if remaining <= 0:
+      break
+    try:
+      items.append(queue.get(timeout = remaining))
+    except Empty:
+      break
+  return items
+
 def writeDbJob(dbName):
   conn = sqlite3.connect(dbName)
   with closing(conn):
     conn.execute('PRAGMA busy_timeout = 1200000;')
+    conn.execute('PRAGMA journal_mode = WAL;')
+    conn.execute('PRAGMA synchronous = NORMAL;')
     while True:
-      serverId, category, timestamp, entries = fetchedLogs.get()
-      fetchedLogs.task_done()
-      if category and timestamp and entries:
-        try:
-          sys.stderr.write('WriteDb: {:02d}.{}.{}\n'.format(serverId, category, timestamp))
-          numNewLogs = insert(conn, entries)
-          sys.stderr.write('Success: {:02d}.{}.{}, {} new entries\n'.format(serverId, category, timestamp, numNewLogs))
-        except:
-          traceback.print_exc()
-
-def fetchLog(serverId, gameServer, cookie, category):
+      batch = takeBatch(fetchedLogs, WRITE_BATCH_SIZE, WRITE_BATCH_LATENCY)
+      for _ in batch:
+        fetchedLogs.task_done()
+      entries = [entry for serverId, category, timestamp, items, gap in batch if category and timestamp and items
+          for entry in items]
+      gaps = [(serverId, category, int(time.time()), gap[0], gap[1])
+          for serverId, category, timestamp, items, gap in batch if gap]
+      if not entries and not gaps:
+        continue
+      try:
+        startTime = time.monotonic()
+        numNewLogs = insert(conn, entries, gaps)
+        sys.stderr.write('Commit: {} results, {} entries, {} new, {} gaps, {:.3f}s, {} queued\n'.format(
+            len(batch), len(entries), numNewLogs, len(gaps), time.monotonic() - startTime, fetchedLogs.qsize()))
+        settleHighWaterMarks(batch, True)
+      except:
+        traceback.print_exc()
+        settleHighWaterMarks(batch, False)
+
+def fetchLog(serverId, session, category, poller):
   try:
     timestamp = time.strftime('%Y%m%d-%H%M%S', time.localtime())
     sys.stderr.write('Request: {:02d}.{}.{}\n'.format(serverId, category, timestamp))
     command = '/dock/getBuild{}Log/'.format(category)
-    request = libzjsn.makeHTTPRequestEx('GET', gameServer, command, cookie)
-    response = libzjsn.sendRawHTTPRequest(gameServer, request)
-    j = libzjsn.decodeHTTPResponse(response)
+    decoder = logDecoder
     if FLAG_LOG_RAW:
-      decompressed = libzjsn.decompressHTTPResponse(response)
-      fileName = 'logs/{:02d}.{}.{}.log'.format(serverId, category, timestamp)
-      with closing(open(fileName, 'wb')) as f:
-        f.write(decompressed)
+      decoder = RawLogDecoder('logs/{:02d}.{}.{}.log'.format(serverId, category, timestamp), logDecoder)
+    # The next poll is the retry: the poller and the shared budget pace it.
+    j = session.issueCommand(command, retryCount = 0, decoder = decoder)
     if 'log' not in j:
       sys.stderr.write('Failure: {:02d}.{}.{}\n'.format(serverId, category, timestamp))
       return
-    entries = [(serverId, e['id'], e['uid'], e['username'], e['createTime'], e['cid'], e['type'], e['res']['oil'], e['res']['ammo'], e['res']['steel'], e['res']['aluminium']) for e in j['log']]
-    fetchedLogs.put((serverId, category, timestamp, entries[:30]))
-    sys.stderr.write('Enqueue: {:02d}.{}.{}\n'.format(serverId, category, timestamp))
+    entries = [(serverId, int(e['id']), e['uid'], e['username'], int(e['createTime']), e['cid'], e['type'], e['res']['oil'], e['res']['ammo'], e['res']['steel'], e['res']['aluminium']) for e in j['log']]
+    entries = entries[:LOG_WINDOW]
+    newEntries, gap = filterNewEntries(serverId, category, entries)
+    if newEntries:
+      fetchedLogs.put((serverId, category, timestamp, newEntries, gap))
+    period = poller.observe(entries, len(newEntries), gap)
+    sys.stderr.write('Enqueue: {:02d}.{}.{}, {} new, {} skipped{}, next poll in {:.1f}s\n'.format(
+        serverId, category, timestamp, len(newEntries), len(entries) - len(newEntries),
+        ', gap after {}'.format(gap[0]) if gap else '', period))
+  except libzjsn.CircuitOpen as e:
+    sys.stderr.write('Skipped: {:02d}.{}, {}\n'.format(serverId, category, e))
   except:
     traceback.print_exc()
 
@@ -76,20 +243,22 @@ def oneServerJob(serverId, category):
   password2 = 'build_{}_123456'.format(serverId)
 
   refreshPeriod = 43200
-  fetchPeriod = 5
+  poller = AdaptivePoller(5)
 
-  fetcherPool = ThreadPoolExecutor(10)
+  # launchFetcher never submits while a fetch is pending, so one worker is enough.
+  fetcherPool = ThreadPoolExecutor(1)
+  pendingFetch = None
 
   scheduler = sched.scheduler()
-  cookie = None
+  session = libzjsn.Session(gameServer)
 
   def updateCookie():
-    nonlocal cookie, user1, user2, password1, password2
+    nonlocal user1, user2, password1, password2
     scheduler.enter(refreshPeriod, 0, updateCookie)
     while True:
       try:
         sys.stderr.write('Login as {}:{}\n'.format(user1, password1))
-        cookie = libzjsn.login(loginServer, gameServer, user1, password1)
+        session.cookie = libzjsn.login(loginServer, gameServer, user1, password1)
         break
       except:
         traceback.print_exc()
@@ -99,9 +268,15 @@ def oneServerJob(serverId, category):
     password1, password2 = password2, password1
 
   def launchFetcher():
-    scheduler.enter(fetchPeriod, 0, launchFetcher)
-    if cookie:
-      fetcherPool.submit(fetchLog, serverId, gameServer, cookie, category)
+    nonlocal pendingFetch
+    if session.cookie and (pendingFetch is None or pendingFetch.done()):
+      wait = requestBudget.take()
+      if wait:
+        # Over the budget shared by all servers: try again as soon as a request is allowed.
+        scheduler.enter(wait, 0, launchFetcher)
+        return
+      pendingFetch = fetcherPool.submit(fetchLog, serverId, session, category, poller)
+    scheduler.enter(poller.period, 0, launchFetcher)
 
   updateCookie()
   launchFetcher()
@@ -115,10 +290,11 @@ def main():
   libzjsn.setSocketTimeout(timeout)
 
   createDb(dbName)
+  loadHighWaterMarks(dbName, category, SERVER_IDS)
   writeDbThread = Thread(target = writeDbJob, name = 'WriteDbThread', args = (dbName,), daemon = True)
   writeDbThread.start()
   
-  for serverId in [2, 3, 4, 5, 6, 7, 8, 9, 10, 11, 12, 13, 14]:
+  for serverId in SERVER_IDS:
     oneServerThread = Thread(target = oneServerJob, name = 'OneServerThread{}'.format(serverId), args = (serverId, category), daemon = True)
     oneServerThread.start()
   
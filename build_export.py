@@ -0,0 +1,85 @@
+#!/usr/bin/python3
+
+import json
+import os
+import sqlite3
+import sys
+
+from contextlib import closing
+
+import numpy
+
+from numpy.lib.format import open_memmap
+
+integerColumns = ['server', 'ID', 'UID', 'time', 'CID', 'type', 'oil', 'ammo', 'steel', 'aluminium']
+
+def minimalDtype(low, high):
+  for dtype in (numpy.int8, numpy.uint8, numpy.int16, numpy.uint16, numpy.int32, numpy.uint32):
+    info = numpy.iinfo(dtype)
+    if info.min <= low and high <= info.max:
+      return numpy.dtype(dtype)
+  return numpy.dtype(numpy.int64)
+
+def exportColumns(dbPath, outDir, chunkSize = 100000):
+  '''Writes build_results as one .npy file per column plus username.json and meta.json.
+
+  Every integer column gets the narrowest dtype that holds its value range. Usernames are dictionary
+  encoded: username.npy holds indexes into the list in username.json. Rows are streamed in chunks
+  straight into memory-mapped output files. Returns: the number of rows exported.'''
+  os.makedirs(outDir, exist_ok = True)
+  with closing(sqlite3.connect(dbPath)) as conn:
+    # Read the statistics and the rows from the same snapshot.
+    conn.execute('BEGIN;')
+    stats = conn.execute('SELECT COUNT(*), COUNT(DISTINCT username), {} FROM build_results;'.format(
+        ', '.join('MIN({0}), MAX({0})'.format(name) for name in integerColumns))).fetchone()
+    count, numUsernames = stats[:2]
+    dtypes = [minimalDtype(stats[2 + 2 * i] or 0, stats[3 + 2 * i] or 0) for i in range(len(integerColumns))]
+    columns = [open_memmap(os.path.join(outDir, name + '.npy'), mode = 'w+', dtype = dtype, shape = (count,))
+        for name, dtype in zip(integerColumns, dtypes)]
+    usernameCodes = open_memmap(os.path.join(outDir, 'username.npy'), mode = 'w+',
+        dtype = minimalDtype(0, max(numUsernames - 1, 0)), shape = (count,))
+
+    usernames = {}
+    cursor = conn.execute('SELECT {}, username FROM build_results LIMIT ?;'.format(', '.join(integerColumns)), (count,))
+    offset = 0
+    while True:
+      rows = cursor.fetchmany(chunkSize)
+      if not rows:
+        break
+      values = list(zip(*rows))
+      end = offset + len(rows)
+      for column, value in zip(columns, values):
+        column[offset:end] = value
+      usernameCodes[offset:end] = [usernames.setdefault(name, len(usernames)) for name in values[-1]]
+      offset = end
+    conn.rollback()
+
+  for column in columns:
+    column.flush()
+  usernameCodes.flush()
+  with open(os.path.join(outDir, 'username.json'), 'w', encoding = 'UTF-8') as f:
+    json.dump(list(usernames), f, ensure_ascii = False)
+  with open(os.path.join(outDir, 'meta.json'), 'w', encoding = 'UTF-8') as f:
+    json.dump({'rows': count, 'columns': integerColumns + ['username']}, f)
+  return count
+
+def loadColumns(directory, mmap = True):
+  '''Returns: (dict of column name to array, list of usernames). Arrays are memory-mapped read-only
+  unless mmap is False.'''
+  with open(os.path.join(directory, 'meta.json'), 'r', encoding = 'UTF-8') as f:
+    meta = json.load(f)
+  mode = 'r' if mmap else None
+  columns = {name: numpy.load(os.path.join(directory, name + '.npy'), mmap_mode = mode) for name in meta['columns']}
+  with open(os.path.join(directory, 'username.json'), 'r', encoding = 'UTF-8') as f:
+    usernames = json.load(f)
+  return (columns, usernames)
+
+def main():
+  if len(sys.argv) != 3:
+    sys.stderr.write('Usage: {} db outDir\n'.format(sys.argv[0]))
+    exit(1)
+  count = exportColumns(sys.argv[1], sys.argv[2])
+  print('{} rows exported'.format(count))
+
+if __name__ == '__main__':
+  main()
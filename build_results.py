@@ -0,0 +1,89 @@
+#!/usr/bin/python3
+
+import sqlite3
+import sys
+
+from contextlib import closing
+
+indexes = [
+  ('build_results_time', '(time)'),
+  ('build_results_server_time', '(server, time)'),
+  ('build_results_cid_time', '(CID, time)'),
+  ('build_results_recipe', '(oil, ammo, steel, aluminium, CID)'),
+  ('build_results_uid_time', '(UID, time)'),
+]
+
+# Query texts are constants so sqlite3 keeps them prepared in its statement cache.
+queries = {
+  'countByCid': ('SELECT CID, COUNT(*) FROM build_results WHERE time >= ? AND time < ? GROUP BY CID;', (0, 0)),
+  'countByCidOnServer': ('SELECT CID, COUNT(*) FROM build_results WHERE server = ? AND time >= ? AND time < ? GROUP BY CID;', (0, 0, 0)),
+  'cidHistory': ('SELECT server, ID, time FROM build_results WHERE CID = ? AND time >= ? AND time < ? ORDER BY time;', (0, 0, 0)),
+  'recipeResults': ('SELECT CID, COUNT(*) FROM build_results WHERE oil = ? AND ammo = ? AND steel = ? AND aluminium = ? GROUP BY CID;', (0, 0, 0, 0)),
+  'userHistory': ('SELECT * FROM build_results WHERE UID = ? ORDER BY time;', (0,)),
+  'serverResults': ('SELECT * FROM build_results WHERE server = ? AND time >= ? AND time < ? ORDER BY time;', (0, 0, 0)),
+}
+
+def createIndexes(conn):
+  with conn:
+    for name, columns in indexes:
+      conn.execute('CREATE INDEX IF NOT EXISTS {} ON build_results {};'.format(name, columns))
+
+def _stream(conn, name, params, batchSize = 1000):
+  cursor = conn.execute(queries[name][0], params)
+  while True:
+    rows = cursor.fetchmany(batchSize)
+    if not rows:
+      return
+    yield from rows
+
+def countByCid(conn, start, end):
+  '''Yields (CID, count) of builds in [start, end).'''
+  return _stream(conn, 'countByCid', (start, end))
+
+def countByCidOnServer(conn, server, start, end):
+  '''Yields (CID, count) of builds on server in [start, end).'''
+  return _stream(conn, 'countByCidOnServer', (server, start, end))
+
+def cidHistory(conn, cid, start, end):
+  '''Yields (server, ID, time) of every build of cid in [start, end), oldest first.'''
+  return _stream(conn, 'cidHistory', (cid, start, end))
+
+def recipeResults(conn, oil, ammo, steel, aluminium):
+  '''Yields (CID, count) of builds with the given recipe.'''
+  return _stream(conn, 'recipeResults', (oil, ammo, steel, aluminium))
+
+def userHistory(conn, uid):
+  '''Yields all builds of uid, oldest first.'''
+  return _stream(conn, 'userHistory', (uid,))
+
+def serverResults(conn, server, start, end):
+  '''Yields all builds on server in [start, end), oldest first.'''
+  return _stream(conn, 'serverResults', (server, start, end))
+
+def checkQueryPlans(conn):
+  '''Returns: a list of (query name, plan details) for queries that scan the table without an index.'''
+  failures = []
+  for name, (sql, params) in queries.items():
+    details = [row[-1] for row in conn.execute('EXPLAIN QUERY PLAN ' + sql, params)]
+    for detail in details:
+      if detail.startswith('SCAN') and 'INDEX' not in detail:
+        failures.append((name, details))
+        break
+  return failures
+
+def main():
+  if len(sys.argv) != 2:
+    sys.stderr.write('Usage: {} db\n'.format(sys.argv[0]))
+    exit(1)
+  with closing(sqlite3.connect(sys.argv[1])) as conn:
+    createIndexes(conn)
+    conn.execute('ANALYZE;')
+    failures = checkQueryPlans(conn)
+    for name, details in failures:
+      print('{} does not use an index: {}'.format(name, '; '.join(details)))
+    if failures:
+      exit(1)
+    print('All queries use an index')
+
+if __name__ == '__main__':
+  main()
@@ -7,9 +7,10 @@ import os
 import time
 import traceback
 
+import global_args
 import libzjsn
 
-from challenge_lib import strategies
+from challenge_lib import battleSteps, loadStrategies, runSteps, strategies, validateStrategy
 from client import BasicClient, BattleSession, BattleWithBrokenShip
 from global_args import extra_args
 from libzjsn import writeDebugJSON as writeJSON
@@ -17,6 +18,7 @@ from libzjsn import writeDebugJSON as writeJSON
 parser = argparse.ArgumentParser()
 parser.add_argument('--fleet-id', type = int, required = True)
 parser.add_argument('--strategy', required = True)
+parser.add_argument('--strategy-file', help = 'Load strategies from this JSON file instead of the built-in ones')
 args = parser.parse_args(extra_args)
 
 logging.basicConfig(level = logging.DEBUG)
@@ -27,76 +29,29 @@ libzjsn.setSocketTimeout(60)
 TARGET_LEVEL = 110
 
 config = json.load(open('challenge.json', 'r'))
+if args.strategy_file:
+  strategies = loadStrategies(args.strategy_file)
 activeStrategy = strategies[args.strategy]
-nodeRules = activeStrategy.nodeRules
-
-def getExpProgress(shipResult):
-  exp = 0
-  if 'exp' in shipResult:
-    exp = int(shipResult['exp'])
-  needed = int(shipResult['nextLevelExpNeed'])
-  return (exp, exp + needed)
 
 def execute(client):
   session = BattleSession(client, args.fleet_id, activeStrategy.mapId)
-  session.start()
-
-  while session.currentNode in activeStrategy.continuingNodes:
-    session.next()
-    currentNodeId = session.currentNode
-    enemyFleetId = session.enemyFleetId
-    enemyShips = session.enemyShips
-    if currentNodeId in nodeRules:
-      if enemyShips:
-        logging.info('Enemy ships:\n' + '\n'.join([ship['title'] for ship in enemyShips]))
-      nodeRule = nodeRules[currentNodeId]
-      formation = nodeRule.apply(enemyFleetId, enemyShips)
-      if formation == 0:
-        logging.info('No matching rule. Abort session.')
-        return
-      elif formation == -1:
-        logging.info('Skipping required. Feature not implemented. Aborting.')
-      else:
-        assert(formation > 0)
-        warReport = session.deal(formation)
-        if warReport:
-          logging.info('Self HP: ' + ' '.join([
-              '{}/{}'.format(warReport.hpBeforeNightSelf[i], warReport.hpMaxSelf[i])
-              for i in range(len(warReport.hpMaxSelf))]))
-          logging.info('Enemy HP: ' + ' '.join([
-              '{}/{}'.format(warReport.hpBeforeNightEnemy[i], warReport.hpMaxEnemy[i])
-              for i in range(len(warReport.hpMaxEnemy))]))
-          warResult = session.getWarResult(False)
-
-          logging.info('Battle result level: %d', int(warResult['warResult']['resultLevel']))
-          logging.info('Levels: %s', ', '.join([str(shipResult['level'])
-              for shipResult in warResult['warResult']['selfShipResults']]))
-          logging.info('Exp: %s', ', '.join(['{}/{}'.format(*getExpProgress(shipResult))
-              for shipResult in warResult['warResult']['selfShipResults']]))
-          logging.info('%d ships in repository', client.getShipCount())
-
-          for shipResult in warResult['warResult']['selfShipResults']:
-            if int(shipResult['level']) == TARGET_LEVEL:
-              return 'One ship reached level {}'.format(TARGET_LEVEL)
-
-          if 'drop500' in warResult and int(warResult['drop500']) == 1:
-            return '500 drop reached'
-          
-          if client.resources.spoils:
-            logging.info('%d spoils', client.resources.spoils)
-            if client.resources.spoils >= int(config['targetSpoils']):
-              return 'Enough spoils for today'
+  return runSteps(battleSteps(client, session, activeStrategy, TARGET_LEVEL, int(config['targetSpoils'])))
 
 def main():
+  sessionCache = libzjsn.SessionCache(global_args.args.session_cache) if global_args.args.session_cache else None
   def makeClient():
     return BasicClient(
         config['loginServer'],
         config['gameServer'],
         config['userName'],
         config['password'],
-        debug = True)
+        debug = True,
+        sessionCache = sessionCache)
   while True:
     client = makeClient()
+    problems = validateStrategy(activeStrategy, client.pveNodes)
+    if problems:
+      raise ValueError('Strategy {} is invalid: {}'.format(args.strategy, '; '.join(problems)))
     try:
       while True:
         try:
@@ -1,3 +1,9 @@
+import json
+import logging
+import time
+
+from libzjsn import MapNodeType
+
 class Matcher:
   def __init__(self):
     pass
@@ -17,19 +23,57 @@ class AssertEnemyMatcher:
     self.enemyCid = enemyCid
 
   def apply(self, enemyFleetId: int, enemyShips: int):
-    for ship in enemyShips:
+    for ship in enemyShips or ():
       if int(ship['shipCid']) == self.enemyCid:
         return True
     return False
 
+class EnemyFleetMatcher:
+  def __init__(self, enemyFleetId: int):
+    self.enemyFleetId = enemyFleetId
+
+  def apply(self, enemyFleetId: int, enemyShips):
+    return enemyFleetId == self.enemyFleetId
+
 class NodeRule:
+  '''An ordered list of (matcher, formation); the first matching rule wins, 0 if none matches.
+
+  The rules are compiled into indexes: enemy CID and enemy fleet ID to the first rule matching them,
+  and the first AllMatcher. apply then costs one lookup per enemy ship whatever the number of rules;
+  only matchers of other types are still tried one by one.'''
+
   def __init__(self, rules):
     self.rules_ = list(rules)
+    self._byCid = {}
+    self._byFleet = {}
+    self._firstAll = len(self.rules_)
+    self._others = []
+    for i, (matcher, formation) in enumerate(self.rules_):
+      if isinstance(matcher, AllMatcher):
+        self._firstAll = min(self._firstAll, i)
+      elif isinstance(matcher, AssertEnemyMatcher):
+        self._byCid.setdefault(matcher.enemyCid, i)
+      elif isinstance(matcher, EnemyFleetMatcher):
+        self._byFleet.setdefault(matcher.enemyFleetId, i)
+      else:
+        self._others.append(i)
+    self._others = [i for i in self._others if i < self._firstAll]
 
   def apply(self, enemyFleetId, enemyShips):
-    for rule in self.rules_:
-      if rule[0].apply(enemyFleetId, enemyShips):
-        return rule[1]
+    best = self._firstAll
+    if best:
+      best = min(best, self._byFleet.get(enemyFleetId, best))
+      if self._byCid:
+        for ship in enemyShips or ():
+          best = min(best, self._byCid.get(int(ship['shipCid']), best))
+      for i in self._others:
+        if i >= best:
+          break
+        if self.rules_[i][0].apply(enemyFleetId, enemyShips):
+          best = i
+          break
+    if best < len(self.rules_):
+      return self.rules_[best][1]
     return 0
 
 class Strategy:
@@ -38,6 +82,54 @@ class Strategy:
     self.continuingNodes = continuingNodes
     self.nodeRules = nodeRules
 
+def _parseRule(rule):
+  formation = int(rule['formation'])
+  if 'enemyCid' in rule:
+    return (AssertEnemyMatcher(int(rule['enemyCid'])), formation)
+  if 'enemyFleetId' in rule:
+    return (EnemyFleetMatcher(int(rule['enemyFleetId'])), formation)
+  return (AllMatcher(), formation)
+
+def loadStrategies(path):
+  '''Reads strategies from a JSON file like
+
+    {"201Boss": {"mapId": 201, "continuingNodes": [20101, 20103, 20105], "nodeRules": {
+      "20103": [{"formation": 1}],
+      "20107": [{"enemyCid": 20100003, "formation": 2}, {"enemyFleetId": 20107, "formation": 4}]}}}
+
+  A rule without enemyCid or enemyFleetId matches everything. Returns: dict of name to Strategy.'''
+  with open(path, 'r', encoding = 'UTF-8') as f:
+    content = json.load(f)
+  loaded = {}
+  for name, strategy in content.items():
+    try:
+      nodeRules = {int(nodeId): NodeRule([_parseRule(rule) for rule in rules])
+          for nodeId, rules in strategy['nodeRules'].items()}
+      loaded[name] = Strategy(int(strategy['mapId']), [int(nodeId) for nodeId in strategy['continuingNodes']], nodeRules)
+    except (KeyError, TypeError, ValueError) as e:
+      raise ValueError('Invalid strategy {} in {}: {!r}'.format(name, path, e)) from e
+  return loaded
+
+def validateStrategy(strategy, pveNodes):
+  '''Checks strategy against the pveNodes of BasicClient. Returns: a list of problems, empty if none.'''
+  problems = []
+  nodeIds = set(strategy.continuingNodes) | set(strategy.nodeRules)
+  for nodeId in sorted(nodeIds):
+    if nodeId not in pveNodes:
+      problems.append('Node {} does not exist'.format(nodeId))
+    elif nodeId // 100 != strategy.mapId:
+      problems.append('Node {} is not on map {}'.format(nodeId, strategy.mapId))
+  for nodeId, nodeRule in sorted(strategy.nodeRules.items()):
+    if nodeId not in pveNodes:
+      continue
+    spied = int(pveNodes[nodeId]['nodeType']) not in [MapNodeType.RESOURCE, MapNodeType.IDLE, MapNodeType.TOLL]
+    if not spied and not all(isinstance(matcher, AllMatcher) for matcher, formation in nodeRule.rules_):
+      problems.append('Node {} has no enemy to match'.format(nodeId))
+    for matcher, formation in nodeRule.rules_:
+      if formation != -1 and not 1 <= formation <= 5:
+        problems.append('Node {} has invalid formation {}'.format(nodeId, formation))
+  return problems
+
 strategies = {
   '201Boss': Strategy(201, [20101, 20103, 20105], {
     20103: NodeRule([(AllMatcher(), 1)]),
@@ -51,3 +143,82 @@ strategies = {
     70102: NodeRule([(AllMatcher(), 5)])
   })
 }
+
+def getExpProgress(shipResult):
+  exp = 0
+  if 'exp' in shipResult:
+    exp = int(shipResult['exp'])
+  needed = int(shipResult['nextLevelExpNeed'])
+  return (exp, exp + needed)
+
+def battleSteps(client, session, strategy, targetLevel, targetSpoils):
+  '''Fights one battle with a client.BattleSession, yielding session.takePendingDelay() after every
+  command. Returns: a message when the account should stop, otherwise None.'''
+  nodeRules = strategy.nodeRules
+
+  session.supply()
+  yield session.takePendingDelay()
+  yield from client.taskAwardSteps()
+  session.challenge()
+  yield session.takePendingDelay()
+
+  while session.currentNode in strategy.continuingNodes:
+    session.advance()
+    yield session.takePendingDelay()
+    if session.needsSpy():
+      session.spy()
+      yield session.takePendingDelay()
+    currentNodeId = session.currentNode
+    enemyFleetId = session.enemyFleetId
+    enemyShips = session.enemyShips
+    if currentNodeId in nodeRules:
+      if enemyShips:
+        logging.info('Enemy ships:\n' + '\n'.join([ship['title'] for ship in enemyShips]))
+      nodeRule = nodeRules[currentNodeId]
+      formation = nodeRule.apply(enemyFleetId, enemyShips)
+      if formation == 0:
+        logging.info('No matching rule. Abort session.')
+        return
+      elif formation == -1:
+        logging.info('Skipping required. Feature not implemented. Aborting.')
+      else:
+        assert(formation > 0)
+        warReport = session.deal(formation)
+        yield session.takePendingDelay()
+        if warReport:
+          logging.info('Self HP: ' + ' '.join([
+              '{}/{}'.format(warReport.hpBeforeNightSelf[i], warReport.hpMaxSelf[i])
+              for i in range(len(warReport.hpMaxSelf))]))
+          logging.info('Enemy HP: ' + ' '.join([
+              '{}/{}'.format(warReport.hpBeforeNightEnemy[i], warReport.hpMaxEnemy[i])
+              for i in range(len(warReport.hpMaxEnemy))]))
+          warResult = session.getWarResult(False)
+          yield session.takePendingDelay()
+          yield from client.taskAwardSteps()
+
+          logging.info('Battle result level: %d', int(warResult['warResult']['resultLevel']))
+          logging.info('Levels: %s', ', '.join([str(shipResult['level'])
+              for shipResult in warResult['warResult']['selfShipResults']]))
+          logging.info('Exp: %s', ', '.join(['{}/{}'.format(*getExpProgress(shipResult))
+              for shipResult in warResult['warResult']['selfShipResults']]))
+          logging.info('%d ships in repository', client.getShipCount())
+
+          for shipResult in warResult['warResult']['selfShipResults']:
+            if int(shipResult['level']) == targetLevel:
+              return 'One ship reached level {}'.format(targetLevel)
+
+          if 'drop500' in warResult and int(warResult['drop500']) == 1:
+            return '500 drop reached'
+          
+          if client.resources.spoils:
+            logging.info('%d spoils', client.resources.spoils)
+            if client.resources.spoils >= targetSpoils:
+              return 'Enough spoils for today'
+
+def runSteps(steps):
+  '''Runs a step generator like battleSteps to the end on this thread. Returns: its return value.'''
+  try:
+    while True:
+      time.sleep(next(steps))
+  except StopIteration as e:
+    return e.value
@@ -0,0 +1,143 @@
+#!/usr/bin/python3
+
+import argparse
+import heapq
+import itertools
+import json
+import logging
+import threading
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+
+import global_args
+import libzjsn
+
+from challenge_lib import battleSteps, loadStrategies, strategies, validateStrategy
+from client import BasicClient, BattleSession, BattleWithBrokenShip
+from global_args import extra_args
+from libzjsn import writeDebugJSON
+
+parser = argparse.ArgumentParser(description = 'Runs challenge.py battles for many accounts in one process.')
+parser.add_argument('accounts', help = 'JSON list of objects with loginServer, gameServer, userName, password, '
+    'fleetId, strategy and targetSpoils')
+parser.add_argument('--threads', type = int, default = 4)
+parser.add_argument('--strategy-file', help = 'Load strategies from this JSON file instead of the built-in ones')
+args = parser.parse_args(extra_args)
+
+logging.basicConfig(level = logging.INFO, format = '%(asctime)s %(threadName)s %(name)s %(message)s')
+
+libzjsn.loadConfig()
+libzjsn.setSocketTimeout(60)
+
+TARGET_LEVEL = 110
+
+if args.strategy_file:
+  strategies = loadStrategies(args.strategy_file)
+
+class StepScheduler:
+  '''Runs step generators on a thread pool.
+
+  A generator yields the seconds to wait before its next step. It is never stepped on two threads at
+  once, and no thread is held while it waits.'''
+
+  def __init__(self, numThreads):
+    self._pool = ThreadPoolExecutor(numThreads)
+    self._timers = []
+    self._sequence = itertools.count()
+    self._active = 0
+    self._condition = threading.Condition()
+
+  def add(self, name, steps, delay = 0):
+    with self._condition:
+      self._active += 1
+      self._schedule(name, steps, delay)
+
+  def _schedule(self, name, steps, delay):
+    heapq.heappush(self._timers, (time.monotonic() + delay, next(self._sequence), name, steps))
+    self._condition.notify()
+
+  def _step(self, name, steps):
+    try:
+      delay = next(steps)
+    except StopIteration as e:
+      logging.info('%s finished: %s', name, e.value)
+    except Exception:
+      logging.exception('%s failed', name)
+    else:
+      with self._condition:
+        self._schedule(name, steps, delay)
+      return
+    with self._condition:
+      self._active -= 1
+      self._condition.notify()
+
+  def run(self):
+    '''Returns when every generator has finished.'''
+    with self._condition:
+      while self._active:
+        if not self._timers:
+          self._condition.wait()
+          continue
+        wait = self._timers[0][0] - time.monotonic()
+        if wait > 0:
+          self._condition.wait(wait)
+          continue
+        dueTime, sequence, name, steps = heapq.heappop(self._timers)
+        self._pool.submit(self._step, name, steps)
+    self._pool.shutdown()
+
+def accountSteps(account, sessionCache):
+  '''The loop of challenge.py's main for one account, as a step generator.'''
+  strategy = strategies[account['strategy']]
+  while True:
+    credentials = (account['loginServer'], account['gameServer'], account['userName'], account['password'])
+    if sessionCache:
+      loginResult = yield from libzjsn.resumeLoginSteps(*credentials, sessionCache)
+    else:
+      loginResult = yield from libzjsn.fullLoginSteps(*credentials)
+    client = BasicClient(*credentials, loginResult = loginResult, deferSleeps = True)
+    problems = validateStrategy(strategy, client.pveNodes)
+    if problems:
+      raise ValueError('Strategy {} is invalid: {}'.format(account['strategy'], '; '.join(problems)))
+    yield 1
+    try:
+      while True:
+        try:
+          session = BattleSession(client, account['fleetId'], strategy.mapId, deferSleeps = True)
+          message = yield from battleSteps(client, session, strategy, TARGET_LEVEL, int(account['targetSpoils']))
+          if message:
+            return message
+          for command in libzjsn.mainScreenCommands:
+            client.issueCommand(command)
+            yield 1 + client.takePendingDelay()
+        except BattleWithBrokenShip as e:
+          repairResult = client.issueCommand('/boat/instantRepairShips/[{}]/'.format(e.shipId), True)
+          writeDebugJSON('instantRepairShips.json', repairResult)
+          yield 2.5 + client.takePendingDelay()
+          yield from client.taskAwardSteps()
+        except libzjsn.ServerError as e:
+          if e.message == '参数错误':
+            logging.info('Ignorable ServerError', exc_info = e)
+            yield 1
+          else:
+            raise
+    except libzjsn.ServerError as e:
+      if e.message in ['数据不存在', '正在出征中']:
+        logging.info('Reload because of ServerError', exc_info = e)
+        yield 1
+      else:
+        raise
+
+def main():
+  with open(args.accounts, 'r', encoding = 'UTF-8') as f:
+    accounts = json.load(f)
+  sessionCache = libzjsn.SessionCache(global_args.args.session_cache) if global_args.args.session_cache else None
+  scheduler = StepScheduler(args.threads)
+  for i, account in enumerate(accounts):
+    # Spread the logins out instead of sending them all at once.
+    scheduler.add('{}/{}'.format(account['userName'], account['fleetId']), accountSteps(account, sessionCache), i)
+  scheduler.run()
+
+if __name__ == '__main__':
+  main()
@@ -1,8 +1,10 @@
+import collections
 import logging
 import os
 import time
 
 import libzjsn
+import roster
 
 from libzjsn import MapNodeType, writeDebugJSON
 
@@ -29,11 +31,32 @@ class Resources:
     self.spoils = None
 
 class BasicClient:
-  def __init__(self, loginServer, gameServer, username, password, debug = False):
-    self._gameServer = gameServer
-    logger.info('Logging in as %s', username)
-    cookie, initGame, pveData, peventData, canBuy, bsea, userInfo, activeUserData, pveUserData, campaignUserData = libzjsn.fullLogin(
-      loginServer, gameServer, username, password)
+  '''A logged in account and the game state it has seen.
+
+  Besides ships and fleets, the client keeps indexes updated as responses arrive: fleetOfShip maps a
+  ship ID to its fleet ID, brokenShips and halfBrokenShips hold ship IDs by libzjsn.isBroken and
+  libzjsn.isHalfBroken, and completedTasks holds CIDs of completed tasks until the server has given
+  their award or rejected the request.
+
+  Listeners added with addListener are called as listener(event, subject) from processGenericResponse:
+  'ship' and 'fleet' with the new Ship or Fleet, 'broken', 'halfBroken' and 'repaired' with the Ship
+  crossing that HP threshold, 'taskCompleted' with the task CID and 'spoils' with the new count.
+
+  loginResult, the tuple returned by libzjsn.fullLogin, skips logging in. With deferSleeps set, pauses
+  are added to pendingDelay instead of slept; see BattleSession. Task awards are then only queued,
+  and the caller sends them by running taskAwardSteps.'''
+
+  def __init__(self, loginServer, gameServer, username, password, debug = False, sessionCache = None,
+      loginResult = None, deferSleeps = False):
+    self.deferSleeps = deferSleeps
+    self.pendingDelay = 0
+    if loginResult is None:
+      logger.info('Logging in as %s', username)
+      if sessionCache:
+        loginResult = libzjsn.resumeLogin(loginServer, gameServer, username, password, sessionCache)
+      else:
+        loginResult = libzjsn.fullLogin(loginServer, gameServer, username, password)
+    cookie, initGame, pveData, peventData, canBuy, bsea, userInfo, activeUserData, pveUserData, campaignUserData = loginResult
     logger.info('Login finished')
     if debug:
       writeDebugJSON('initGame.json', initGame)
@@ -45,9 +68,16 @@ class BasicClient:
       writeDebugJSON('activeUserData.json', activeUserData)
       writeDebugJSON('pveUserData.json', pveUserData)
       writeDebugJSON('campaignUserData.json', campaignUserData)
-    self._cookie = cookie
+    self._session = libzjsn.Session(gameServer, cookie)
+    self.listeners = []
+    self.brokenShips = set()
+    self.halfBrokenShips = set()
+    self.completedTasks = set()
+    self._taskAwards = collections.deque()
+    self._collectingTaskAwards = False
     self._gatherShips(initGame)
     self._gatherFleets(initGame)
+    self.roster = roster.RosterView(self.ships.values(), self.fleets.values()) if roster.numpy else None
     self._processPveData(pveData)
     self.resources = Resources()
 
@@ -55,19 +85,25 @@ class BasicClient:
     self.ships = {}
 
     userShipVO = initGame['userShipVO']
+    logShips = logger.isEnabledFor(logging.DEBUG)
     for ship in userShipVO:
-      shipId = int(ship['id'])
-      logger.debug('Ship %d: %s(%s)', shipId, libzjsn.getCanonicalShipName(ship['shipCid']), ship['title'])
-      self.ships[shipId] = ship
+      ship = libzjsn.Ship(ship)
+      if logShips:
+        logger.debug('Ship %d: %s(%s)', ship.id, libzjsn.getCanonicalShipName(ship.cid), ship['title'])
+      self.ships[ship.id] = ship
+      self._indexShip(ship)
 
   def _gatherFleets(self, initGame):
     self.fleets = {}
+    self.fleetOfShip = {}
     
     fleetVo = initGame['fleetVo']
     for fleet in fleetVo:
-      fleetId = int(fleet['id'])
-      logger.debug('Fleet %d: %s', fleetId, fleet['title'])
-      self.fleets[fleetId] = fleet
+      fleet = libzjsn.Fleet(fleet)
+      logger.debug('Fleet %d: %s', fleet.id, fleet['title'])
+      self.fleets[fleet.id] = fleet
+      for shipId in fleet.shipIds:
+        self.fleetOfShip[shipId] = fleet.id
 
   def _processPveData(self, pveData):
     self.pveLevels = {}
@@ -78,15 +114,64 @@ class BasicClient:
     for node in pveData['pveNode']:
       self.pveNodes[int(node['id'])] = node
   
+  def _pause(self, seconds):
+    if self.deferSleeps:
+      self.pendingDelay += seconds
+    else:
+      time.sleep(seconds)
+
+  def takePendingDelay(self):
+    delay = self.pendingDelay
+    self.pendingDelay = 0
+    return delay
+
+  def addListener(self, listener):
+    self.listeners.append(listener)
+
+  def removeListener(self, listener):
+    self.listeners.remove(listener)
+
+  def _notify(self, event, subject):
+    for listener in list(self.listeners):
+      try:
+        listener(event, subject)
+      except Exception:
+        logger.exception('Listener failed on %s', event)
+
+  def _indexShip(self, ship):
+    '''Updates the HP indexes. Returns: the events of the thresholds ship crossed.'''
+    events = []
+    for index, detector, event in ((self.brokenShips, libzjsn.isBroken, 'broken'),
+        (self.halfBrokenShips, libzjsn.isHalfBroken, 'halfBroken')):
+      if detector(ship):
+        if ship.id not in index:
+          index.add(ship.id)
+          events.append(event)
+      elif ship.id in index:
+        index.discard(ship.id)
+        if event == 'halfBroken':
+          events.append('repaired')
+    return events
+
+  def _updateShip(self, ship):
+    self.ships[ship.id] = ship
+    if self.roster is not None:
+      self.roster.update(ship)
+    events = self._indexShip(ship)
+    if self.listeners:
+      self._notify('ship', ship)
+      for event in events:
+        self._notify(event, ship)
+
   def _addNewShip(self, ship):
-    shipId = int(ship['id'])
-    assert(shipId not in self.ships)
-    self.ships[shipId] = ship
+    ship = libzjsn.Ship(ship)
+    assert(ship.id not in self.ships)
+    self._updateShip(ship)
   
   def _replaceShip(self, ship):
-    shipId = int(ship['id'])
-    assert(shipId in self.ships)
-    self.ships[shipId] = ship
+    ship = libzjsn.Ship(ship)
+    assert(ship.id in self.ships)
+    self._updateShip(ship)
   
   def _processNewShipVO(self, newShipVO):
     for ship in newShipVO:
@@ -95,6 +180,21 @@ class BasicClient:
   def _processShipVO(self, shipVO):
     for ship in shipVO:
       self._replaceShip(ship)
+
+  def _processFleetVo(self, fleetVo):
+    for fleet in fleetVo:
+      fleet = libzjsn.Fleet(fleet)
+      old = self.fleets.get(fleet.id)
+      if old is not None:
+        for shipId in old.shipIds:
+          if self.fleetOfShip.get(shipId) == fleet.id:
+            del self.fleetOfShip[shipId]
+      for shipId in fleet.shipIds:
+        self.fleetOfShip[shipId] = fleet.id
+      self.fleets[fleet.id] = fleet
+      self._notify('fleet', fleet)
+    if self.roster is not None:
+      self.roster.setFleets(self.fleets.values())
   
   def _processUpdateTaskVo(self, updateTaskVo):
     def conditionSatisfied(condition):
@@ -103,8 +203,14 @@ class BasicClient:
     for task in updateTaskVo:
       if all((conditionSatisfied(cond) for cond in task['condition'])):
         taskCid = int(task['taskCid'])
-        self.getTaskAward(taskCid)
-        time.sleep(1)
+        if taskCid in self.completedTasks:
+          continue
+        self.completedTasks.add(taskCid)
+        self._taskAwards.append(taskCid)
+        self._notify('taskCompleted', taskCid)
+    if not self.deferSleeps and not self._collectingTaskAwards:
+      for delay in self.taskAwardSteps():
+        pass
   
   def _processSpoils(self, spoils):
     try:
@@ -112,39 +218,69 @@ class BasicClient:
     except:
       logger.info('Unknown "spoils" data')
     self.resources.spoils = spoils
+    self._notify('spoils', spoils)
+
+  # Response key to handler; None marks keys that are known but not used.
+  _responseHandlers = {
+    'userVo': None,
+    'packageVo': None,
+    'shipVO': _processShipVO,
+    'shipVOs': _processShipVO,
+    'newShipVO': _processNewShipVO,
+    'fleetVo': _processFleetVo,
+    'updateTaskVo': _processUpdateTaskVo,
+    'spoils': _processSpoils,
+  }
   
   def processGenericResponse(self, response):
+    handlers = self._responseHandlers
     for key, data in response.items():
-      if key == 'userVo':
-        pass
-      elif key == 'packageVo':
-        pass
-      elif key == 'shipVO' or key == 'shipVOs':
-        self._processShipVO(data)
-      elif key == 'newShipVO':
-        self._processNewShipVO(data)
-      elif key == 'updateTaskVo':
-        self._processUpdateTaskVo(data)
-      elif key == 'spoils':
-        self._processSpoils(data)
-      else:
+      if key not in handlers:
         logger.debug('Unknown response key: %s', key)
+        continue
+      handler = handlers[key]
+      if handler:
+        handler(self, data)
   
   def getTaskAward(self, taskCid):
-    return self.issueCommand('/task/getAward/{}/'.format(taskCid), True)
+    try:
+      result = self.issueCommand('/task/getAward/{}/'.format(taskCid), True)
+    except libzjsn.ServerError:
+      # Already awarded or gone.
+      self.completedTasks.discard(taskCid)
+      raise
+    except Exception:
+      # No answer; keep the task to try again with the next taskAwardSteps.
+      if taskCid in self.completedTasks and taskCid not in self._taskAwards:
+        self._taskAwards.appendleft(taskCid)
+      raise
+    self.completedTasks.discard(taskCid)
+    return result
+
+  def taskAwardSteps(self):
+    '''Requests the awards of the completed tasks one at a time, yielding the pause after each like
+    battleSteps. Awards of tasks completed by these requests are collected too.'''
+    self._collectingTaskAwards = True
+    try:
+      while self._taskAwards:
+        self.getTaskAward(self._taskAwards.popleft())
+        self._pause(1)
+        yield self.takePendingDelay()
+    finally:
+      self._collectingTaskAwards = False
   
   def getShipCount(self):
     return len(self.ships)
   
   def getFleetDetails(self, fleetId):
     fleet = self.fleets[fleetId]
-    return [self.ships[int(shipId)] for shipId in fleet['ships']]
+    return [self.ships[shipId] for shipId in fleet.shipIds]
 
   def simulateMainScreen(self):
-    return libzjsn.simulateMainScreen(self._gameServer, self._cookie)
+    return self._session.commandSeries(libzjsn.mainScreenCommands, 1)
   
   def issueCommand(self, command, processResult = False):
-    response = libzjsn.issueCommand(self._gameServer, command, self._cookie)
+    response = self._session.issueCommand(command)
     if processResult:
       self.processGenericResponse(response)
     return response
@@ -158,34 +294,63 @@ class DayWarReport:
     self.hpMaxEnemy = [ship['hpMax'] for ship in dayWarReport['enemyShips']]
 
 class BattleSession:
-  def __init__(self, client, fleetId, mapId):
+  '''Drives one battle of a fleet on a map.
+
+  Every command is followed by a pause like the game client's. With deferSleeps set, pauses are added
+  to pendingDelay instead of slept, and the caller must wait them out between calls; start and next
+  are then split into supply/challenge and advance/spy so that no two commands go out back to back.'''
+
+  def __init__(self, client, fleetId, mapId, deferSleeps = False):
     self._client = client
     self._fleetId = fleetId
     self._mapId = mapId
+    self.deferSleeps = deferSleeps
+    self.pendingDelay = 0
 
     self.currentNode = int(client.pveLevels[mapId]['initNodeId'])
 
     self.enemyFleetId = 0
     self.enemyShips = None
 
+  def _pause(self, seconds):
+    if self.deferSleeps:
+      self.pendingDelay += seconds
+    else:
+      time.sleep(seconds)
+
+  def takePendingDelay(self):
+    '''Returns: the pauses deferred by this session and its client since the last call.'''
+    delay = self.pendingDelay + self._client.takePendingDelay()
+    self.pendingDelay = 0
+    return delay
+
   def start(self):
-    client = self._client
-    fleetId = self._fleetId
-    mapId = self._mapId
+    self.supply()
+    self.challenge()
 
+  def supply(self):
     self._detectBrokenShips(libzjsn.isHalfBroken)
 
-    supplyResult = client.issueCommand('/boat/supplyBoats/[{}]/{}/{}/'.format(
-        ','.join([str(ship['id']) for ship in self._getSelfShips()]), mapId, 0), True)
+    supplyResult = self._client.issueCommand('/boat/supplyBoats/[{}]/{}/{}/'.format(
+        ','.join([str(ship.id) for ship in self._getSelfShips()]), self._mapId, 0), True)
     writeDebugJSON('supplyBoats.json', supplyResult)
-    time.sleep(1)
+    self._pause(1)
+
+  def challenge(self):
+    mapId = self._mapId
+    fleetId = self._fleetId
 
-    startingData = client.issueCommand('/pve/cha11enge/{}/{}/0/'.format(mapId, fleetId))
+    startingData = self._client.issueCommand('/pve/cha11enge/{}/{}/0/'.format(mapId, fleetId))
     writeDebugJSON('cha11enge.{}.{}.json'.format(mapId, fleetId), startingData)
     assert(int(startingData['pveLevelEnd']) == 0)
     assert(int(startingData['status']) == 1)
 
   def next(self):
+    self.advance()
+    if self.needsSpy():
+      self.spy()
+
+  def advance(self):
     self._detectBrokenShips(libzjsn.isBroken)
 
     newNext = self._client.issueCommand('/pve/newNext/')
@@ -193,15 +358,18 @@ class BattleSession:
     self.currentNode = int(newNext['node'])
     self.enemyFleetId = 0
     self.enemyShips = None
-    time.sleep(1)
-    
+    self._pause(1)
+
+  def needsSpy(self):
     nodeType = int(self._client.pveNodes[self.currentNode]['nodeType'])
-    if nodeType not in [MapNodeType.RESOURCE, MapNodeType.IDLE, MapNodeType.TOLL]:
-      spy = self._client.issueCommand('/pve/spy/')
-      writeDebugJSON('spy.json', spy)
-      self.enemyFleetId = int(spy['enemyVO']['enemyFleet']['id'])
-      self.enemyShips = spy['enemyVO']['enemyShips']
-      time.sleep(1)
+    return nodeType not in [MapNodeType.RESOURCE, MapNodeType.IDLE, MapNodeType.TOLL]
+
+  def spy(self):
+    spy = self._client.issueCommand('/pve/spy/')
+    writeDebugJSON('spy.json', spy)
+    self.enemyFleetId = int(spy['enemyVO']['enemyFleet']['id'])
+    self.enemyShips = spy['enemyVO']['enemyShips']
+    self._pause(1)
 
   def deal(self, formationId):
     dealResult = self._client.issueCommand(
@@ -210,7 +378,7 @@ class BattleSession:
 
     if 'warReport' in dealResult:
       dayWarReport = dealResult['warReport']
-      time.sleep(10)
+      self._pause(10)
       return DayWarReport(dayWarReport)
     else:
       return None
@@ -220,16 +388,16 @@ class BattleSession:
         '/pve/getWarResult/{}/'.format(1 if nightWar else 0),
         True)
     writeDebugJSON('warResult.json', warResult)
-    time.sleep(1)
+    self._pause(1)
     return warResult
 
   def _detectBrokenShips(self, detector):
     selfShips = self._getSelfShips()
+    halfBrokenShips = self._client.halfBrokenShips
 
     for ship in selfShips:
-      if libzjsn.isHalfBroken(ship):
-        raise BattleWithBrokenShip(
-            ship['id'], ship['shipCid'], ship['battleProps']['hp'], ship['battlePropsMax']['hp'])
+      if ship.id in halfBrokenShips:
+        raise BattleWithBrokenShip(ship.id, ship.cid, ship.hp, ship.maxHp)
 
   def _getSelfShips(self):
     selfShips = self._client.getFleetDetails(self._fleetId)
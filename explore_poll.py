@@ -1,11 +1,13 @@
 #!/usr/bin/python3
 
+import heapq
 import json
 import logging
 import os
 import time
 import traceback
 
+import global_args
 import libzjsn
 
 from libzjsn import writeDebugJSON as writeJSON
@@ -19,11 +21,25 @@ with open('explore_poll.conf', 'r', encoding = 'UTF-8') as conf:
   LOGIN_SERVER, GAME_SERVER, USER_NAME, PASSWORD, POLL_INTERVAL = [l.strip() for l in conf]
   POLL_INTERVAL = int(POLL_INTERVAL)
 
-def pollOnce():
+sessionCache = libzjsn.SessionCache(global_args.args.session_cache) if global_args.args.session_cache else None
+
+def armTimer(timers, level, offset):
+  '''Schedules the expedition of level at the local time its endTime has passed on the server.'''
+  heapq.heappush(timers, (int(level['endTime']) + 1 - offset, int(level['exploreId']), int(level['fleetId'])))
+
+def resync():
+  '''Logs in and arms a timer for every running expedition.
+
+  Returns: (session, timers, offset), where timers is a heap of (due local time, exploreId, fleetId)
+  and offset is server time minus local time.'''
   print('Logging in...')
-  cookie, initGame, pveData, peventData, canBuy, bsea, userInfo, activeUserData, pveUserData, campaignUserData = libzjsn.fullLogin(
-      LOGIN_SERVER, GAME_SERVER, USER_NAME, PASSWORD)
+  if sessionCache:
+    loginResult = libzjsn.resumeLogin(LOGIN_SERVER, GAME_SERVER, USER_NAME, PASSWORD, sessionCache)
+  else:
+    loginResult = libzjsn.fullLogin(LOGIN_SERVER, GAME_SERVER, USER_NAME, PASSWORD)
+  cookie, initGame, pveData, peventData, canBuy, bsea, userInfo, activeUserData, pveUserData, campaignUserData = loginResult
   print('Login finished.')
+  session = libzjsn.Session(GAME_SERVER, cookie)
   writeJSON('initGame.json', initGame)
   writeJSON('pveData.json', pveData)
   writeJSON('peventData.json', peventData)
@@ -33,29 +49,43 @@ def pollOnce():
   writeJSON('activeUserData.json', activeUserData)
   writeJSON('pveUserData.json', pveUserData)
   writeJSON('campaignUserData.json', campaignUserData)
-  
-  serverTime = int(initGame['systime'])
-  exploreLevels = initGame['pveExploreVo']['levels']
-  exploreLevels = sorted(exploreLevels, key = lambda x: int(x['exploreId']))
-  
-  for level in exploreLevels:
-    exploreId = int(level['exploreId'])
-    fleetId = int(level['fleetId'])
-    endTime = int(level['endTime'])
-    if endTime >= serverTime:
-      print('Explore {}, fleet {}: unfinished.'.format(exploreId, fleetId))
-    else:
-      print('Explore {}, fleet {}: finished.'.format(exploreId, fleetId))
-      exploreResult = libzjsn.getExploreResult(GAME_SERVER, exploreId, cookie)
-      writeJSON('exploreResult.{}.json'.format(exploreId), exploreResult)
-      startExploreResult = libzjsn.startExplore(GAME_SERVER, fleetId, exploreId, cookie)
-      writeJSON('exploreStart.{}.json'.format(exploreId), startExploreResult)
+
+  offset = int(initGame['systime']) - time.time()
+  timers = []
+  for level in initGame['pveExploreVo']['levels']:
+    armTimer(timers, level, offset)
+  for dueTime, exploreId, fleetId in sorted(timers):
+    print('Explore {}, fleet {}: due at {}.'.format(exploreId, fleetId, time.strftime('%H:%M:%S', time.localtime(dueTime))))
+  return (session, timers, offset)
+
+def collectDue(session, timers, offset):
+  '''Collects and restarts every expedition whose timer is due, re-arming it from the startExplore
+  response. Returns: the server time offset, updated if the response carries systime.'''
+  while timers and timers[0][0] <= time.time():
+    dueTime, exploreId, fleetId = heapq.heappop(timers)
+    print('Explore {}, fleet {}: finished.'.format(exploreId, fleetId))
+    exploreResult = session.getExploreResult(exploreId)
+    writeJSON('exploreResult.{}.json'.format(exploreId), exploreResult)
+    startExploreResult = session.startExplore(fleetId, exploreId)
+    writeJSON('exploreStart.{}.json'.format(exploreId), startExploreResult)
+    if 'systime' in startExploreResult:
+      offset = int(startExploreResult['systime']) - time.time()
+    levels = startExploreResult.get('pveExploreVo', {}).get('levels', [])
+    level = next((level for level in levels if int(level['exploreId']) == exploreId), None)
+    if level is None:
+      raise ValueError('No endTime of explore {} in the startExplore response.'.format(exploreId))
+    armTimer(timers, level, offset)
+  return offset
 
 def main():
   while True:
     try:
-      print(time.strftime('%Y-%m-%d %H:%M:%S polling start.'))
-      pollOnce()
+      print(time.strftime('%Y-%m-%d %H:%M:%S resync.'))
+      session, timers, offset = resync()
+      while timers:
+        time.sleep(max(0, timers[0][0] - time.time()))
+        offset = collectDue(session, timers, offset)
+      print('No explore running.')
     except:
       traceback.print_exc()
     time.sleep(POLL_INTERVAL)
@@ -3,5 +3,11 @@ import os.path
 
 parser = argparse.ArgumentParser()
 parser.add_argument('--debug-data-dir')
+parser.add_argument('--debug-indent', type = int, help = 'Indent debug dumps, compact by default')
+parser.add_argument('--debug-compress', action = 'store_true', help = 'Gzip debug dumps')
+parser.add_argument('--debug-max-bytes', type = int, help = 'Delete the oldest debug dumps beyond this total size')
+parser.add_argument('--debug-max-files', type = int, help = 'Delete the oldest debug dumps beyond this count')
+parser.add_argument('--debug-queue-size', type = int, default = 256, help = 'Drop debug dumps when this many are pending')
+parser.add_argument('--session-cache', help = 'Reuse login cookies stored in this file')
 
 args, extra_args = parser.parse_known_args()
@@ -1,22 +1,41 @@
+import atexit
 import base64
 import collections
+import contextlib
+import gzip
 import hashlib
 import json
+import json.scanner
 import logging
+import math
 import os
 import os.path
+import pickle
+import queue
+import random
 import re
 import socket
+import threading
 import time
 import urllib.parse
 import uuid
 import zlib
 
+from collections.abc import Mapping
 from enum import IntEnum
 
-from global_args import args
+try:
+  import orjson
+except ImportError:
+  orjson = None
+
+try:
+  import fcntl
+except ImportError:
+  fcntl = None
 
 client_version = '3.8.0'
+user_agent = 'Dalvik/1.6.0 (Linux; U; Android 4.4.2; SM-G900F Build/KOT49H)'
 
 logger = logging.getLogger('libzjsn')
 
@@ -30,16 +49,95 @@ class MapNodeType(IntEnum):
   IDLE = 4
   TOLL = 5
 
-def loadConfig(path = 'init.json'):
+class LazyConfig(Mapping):
+  '''A read-only mapping whose values are unpickled on first access.'''
+
+  def __init__(self, pickledValues):
+    self._pickled = pickledValues
+    self._values = {}
+
+  def __getitem__(self, key):
+    try:
+      return self._values[key]
+    except KeyError:
+      value = pickle.loads(self._pickled[key])
+      self._values[key] = value
+      return value
+
+  def __iter__(self):
+    return iter(self._pickled)
+
+  def __len__(self):
+    return len(self._pickled)
+
+class LazyIndex(Mapping):
+  '''A read-only mapping unpickled as a whole on first access.'''
+
+  def __init__(self, pickled):
+    self._pickled = pickled
+    self._value = None
+
+  def _get(self):
+    if self._value is None:
+      self._value = pickle.loads(self._pickled)
+      self._pickled = None
+    return self._value
+
+  def __getitem__(self, key):
+    return self._get()[key]
+
+  def __iter__(self):
+    return iter(self._get())
+
+  def __len__(self):
+    return len(self._get())
+
+def _configCacheKey(path):
+  stat = os.stat(path)
+  return (stat.st_size, stat.st_mtime_ns)
+
+def _buildShipIndex(config):
+  index = {}
+  for ship in config['shipCardWu']:
+    cid = int(ship['cid'])
+    index[cid] = ship
+  return index
+
+def _writeConfigCache(cachePath, key, config, index):
+  sections = {name: pickle.dumps(value, pickle.HIGHEST_PROTOCOL) for name, value in config.items()}
+  indexes = {'shipByCid': pickle.dumps(index, pickle.HIGHEST_PROTOCOL)}
+  tempPath = '{}.{}.tmp'.format(cachePath, os.getpid())
+  try:
+    with open(tempPath, 'wb') as f:
+      pickle.dump((key, sections, indexes), f, pickle.HIGHEST_PROTOCOL)
+    os.replace(tempPath, cachePath)
+  except OSError:
+    logger.warning('Cannot write config cache %s', cachePath, exc_info = True)
+
+def loadConfig(path = 'init.json', cachePath = None):
+  '''Loads init.json, going through a compiled cache next to it when possible.
+
+  The cache is keyed on the size and mtime of path and stores every top-level section and the
+  shipByCid index pickled separately, so each is only materialized when first used.'''
   global initConfig
   global shipByCid
+  if cachePath is None:
+    cachePath = path + '.cache'
+  key = _configCacheKey(path)
+  try:
+    with open(cachePath, 'rb') as f:
+      cachedKey, sections, indexes = pickle.load(f)
+    if cachedKey == key:
+      initConfig = LazyConfig(sections)
+      shipByCid = LazyIndex(indexes['shipByCid'])
+      return
+  except (OSError, pickle.UnpicklingError, EOFError, ValueError):
+    pass
+
   with open(path, 'r', encoding = 'UTF-8') as configFile:
     initConfig = json.load(configFile, object_pairs_hook=collections.OrderedDict)
-  
-  shipByCid = {}
-  for ship in initConfig['shipCardWu']:
-    cid = int(ship['cid'])
-    shipByCid[cid] = ship
+  shipByCid = _buildShipIndex(initConfig)
+  _writeConfigCache(cachePath, key, initConfig, shipByCid)
 
 class Error(Exception):
   def __str__(self):
@@ -67,27 +165,575 @@ class LoginError(Error):
   def __init__(self, message):
     self.message = message
 
+class RetriesExhausted(Error):
+  def __init__(self, command, attempts, reason):
+    self.command = command
+    self.attempts = attempts
+    self.message = 'Command {} failed after {} attempts: {}'.format(command, attempts, reason)
+
+class CircuitOpen(Error):
+  def __init__(self, host, retryAfter):
+    self.host = host
+    self.retryAfter = retryAfter
+    self.message = 'Server {} is failing, next probe in {:.1f}s'.format(host, retryAfter)
+
 def setSocketTimeout(timeout):
   socket.setdefaulttimeout(timeout)
 
-def writeDebugJSON(path, content):
+class DebugWriter:
+  '''Writes JSON dumps under directory from a background thread.
+
+  put never blocks: when queueSize dumps are already waiting, the dump is dropped and counted in
+  dropped. Content is serialized by the writer thread, so it must not be modified after put. With
+  compress set, files get a .gz suffix. Once the files written exceed maxBytes in total or maxFiles in
+  number, the oldest are deleted; files already in directory are counted too.'''
+
+  def __init__(self, directory, queueSize = 256, indent = None, compress = False, maxBytes = None, maxFiles = None):
+    self.directory = directory
+    self.indent = indent
+    self.compress = compress
+    self.maxBytes = maxBytes
+    self.maxFiles = maxFiles
+    self.dropped = 0
+    self._queue = queue.Queue(queueSize)
+    self._files = collections.OrderedDict()
+    self._totalBytes = 0
+    self._thread = None
+    self._lock = threading.Lock()
+
+  def put(self, path, content):
+    if self._thread is None:
+      with self._lock:
+        if self._thread is None:
+          self._thread = threading.Thread(target = self._run, name = 'DebugWriter', daemon = True)
+          self._thread.start()
+    try:
+      self._queue.put_nowait((path, content))
+    except queue.Full:
+      self.dropped += 1
+      if self.dropped == 1 or self.dropped % 100 == 0:
+        logger.warning('%d debug dumps dropped', self.dropped)
+
+  def flush(self, timeout = None):
+    '''Waits until every queued dump is written, or at most timeout seconds. Returns: whether they were.'''
+    if self._thread is None:
+      return True
+    deadline = None if timeout is None else time.monotonic() + timeout
+    with self._queue.all_tasks_done:
+      while self._queue.unfinished_tasks:
+        if not self._thread.is_alive():
+          return False
+        remaining = 1 if deadline is None else min(1, deadline - time.monotonic())
+        if remaining <= 0:
+          return False
+        self._queue.all_tasks_done.wait(remaining)
+    return True
+
+  def _scan(self):
+    existing = []
+    for root, dirs, files in os.walk(self.directory):
+      for name in files:
+        try:
+          stat = os.stat(os.path.join(root, name))
+        except OSError:
+          continue
+        existing.append((stat.st_mtime, os.path.join(root, name), stat.st_size))
+    for mtime, fullPath, size in sorted(existing):
+      self._files[fullPath] = size
+      self._totalBytes += size
+
+  def _write(self, path, content):
+    data = json.dumps(content, ensure_ascii = False, indent = self.indent).encode('UTF-8')
+    fullPath = os.path.join(self.directory, path)
+    if self.compress:
+      data = gzip.compress(data)
+      fullPath += '.gz'
+    os.makedirs(os.path.dirname(fullPath), exist_ok = True)
+    with open(fullPath, 'wb') as f:
+      f.write(data)
+    self._totalBytes += len(data) - self._files.pop(fullPath, 0)
+    self._files[fullPath] = len(data)
+    while self._files and ((self.maxBytes is not None and self._totalBytes > self.maxBytes) or
+        (self.maxFiles is not None and len(self._files) > self.maxFiles)):
+      oldPath, size = self._files.popitem(last = False)
+      self._totalBytes -= size
+      try:
+        os.remove(oldPath)
+      except OSError:
+        pass
+
+  def _run(self):
+    try:
+      self._scan()
+    except Exception:
+      logger.exception('Scanning %s failed, old debug dumps are not rotated', self.directory)
+    while True:
+      path, content = self._queue.get()
+      try:
+        self._write(path, content)
+      except Exception:
+        logger.exception('Writing debug dump %s failed', path)
+      finally:
+        self._queue.task_done()
+
+_debugWriter = None
+_debugWriterLock = threading.Lock()
+
+def getDebugWriter():
+  '''Returns: the DebugWriter configured by global_args, or None without --debug-data-dir.'''
+  global _debugWriter
+  from global_args import args
   if not args.debug_data_dir:
-    return
-  fullPath = os.path.join(args.debug_data_dir, path)
-  os.makedirs(os.path.dirname(fullPath), exist_ok = True)
-  with open(fullPath, 'w', encoding = 'UTF-8', newline = '\n') as f:
-    json.dump(content, f, ensure_ascii = False, indent = 2)
-
-def sendRawHTTPRequest(host, request):
-  with socket.create_connection((host, 80)) as s:
-    s.sendall(request)
-    rawChunks = []
+    return None
+  with _debugWriterLock:
+    if _debugWriter is None:
+      _debugWriter = DebugWriter(args.debug_data_dir, args.debug_queue_size, args.debug_indent,
+          args.debug_compress, args.debug_max_bytes, args.debug_max_files)
+      atexit.register(_debugWriter.flush, 10)
+  return _debugWriter
+
+def writeDebugJSON(path, content):
+  writer = getDebugWriter()
+  if writer:
+    writer.put(path, content)
+
+class ConnectionPool:
+  '''Keeps idle keep-alive connections per host. Safe to share between threads.'''
+
+  def __init__(self, maxIdlePerHost = 4, port = 80):
+    self.maxIdlePerHost = maxIdlePerHost
+    self.port = port
+    self._lock = threading.Lock()
+    self._idle = collections.defaultdict(collections.deque)
+
+  def acquire(self, host, record = None):
+    '''Returns: (socket, reused). reused is True if the socket was taken from the pool.'''
+    with self._lock:
+      idle = self._idle[host]
+      if idle:
+        return (idle.pop(), True)
+    startTime = time.perf_counter()
+    addresses = socket.getaddrinfo(host, self.port, type = socket.SOCK_STREAM)
+    resolvedTime = time.perf_counter()
+    error = None
+    for family, type, proto, canonicalName, address in addresses:
+      try:
+        s = socket.create_connection(address[:2])
+        break
+      except OSError as e:
+        error = e
+    else:
+      raise error
+    if record:
+      record.addPhase('dns', resolvedTime - startTime)
+      record.addPhase('connect', time.perf_counter() - resolvedTime)
+    return (s, False)
+
+  def release(self, host, s):
+    with self._lock:
+      idle = self._idle[host]
+      if len(idle) < self.maxIdlePerHost:
+        idle.append(s)
+        return
+    s.close()
+
+  def clear(self):
+    with self._lock:
+      sockets = [s for idle in self._idle.values() for s in idle]
+      self._idle.clear()
+    for s in sockets:
+      s.close()
+
+defaultPool = ConnectionPool()
+
+class StaleConnection(Exception):
+  pass
+
+class HTTPResponse:
+  '''A parsed HTTP/1.1 response. Header names are lower-cased.'''
+
+  def __init__(self):
+    self.code = None
+    self.message = None
+    self.headers = []
+    self.body = bytearray()
+    self.raw = None
+    self.keepAlive = True
+
+  def getHeader(self, name, default = None):
+    for key, value in self.headers:
+      if key == name:
+        return value
+    return default
+
+  def getHeaders(self, name):
+    return [value for key, value in self.headers if key == name]
+
+class IncompleteResponse(Exception):
+  pass
+
+class ResponseTooLarge(Error):
+  def __init__(self, limit):
+    self.limit = limit
+    self.message = 'Inflated response exceeds {} bytes'.format(limit)
+
+class HTTPResponseParser:
+  '''Incremental HTTP/1.1 response parser.
+
+  Feed it the bytes read from the socket in any split. Headers are parsed once; the body is decoded in
+  a single pass for chunked, Content-Length and close-delimited responses, copying every body byte
+  exactly once. With bodySink set, body bytes are handed to it as memoryviews instead of being
+  collected in response.body.'''
+
+  _HEAD = 0
+  _CHUNK_SIZE = 1
+  _CHUNK_DATA = 2
+  _CHUNK_END = 3
+  _TRAILER = 4
+  _FIXED_BODY = 5
+  _CLOSE_BODY = 6
+  _DONE = 7
+
+  _statusLine = re.compile(br'HTTP/1\.[01] ([0-9]+) ?(.*)')
+
+  def __init__(self, retainRaw = True, bodySink = None):
+    self.response = HTTPResponse()
+    self._bodySink = bodySink if bodySink else self.response.body.extend
+    self._state = self._HEAD
+    self._partialLine = bytearray()
+    self._remaining = 0
+    self._raw = bytearray() if retainRaw else None
+
+  @property
+  def done(self):
+    return self._state == self._DONE
+
+  def feed(self, data):
+    '''Consumes data. Returns the bytes following the end of the response, if any.'''
+    view = memoryview(data)
+    pos = 0
+    end = len(data)
+    while pos < end and self._state != self._DONE:
+      state = self._state
+      if state == self._CHUNK_DATA or state == self._FIXED_BODY:
+        size = min(self._remaining, end - pos)
+        self._bodySink(view[pos:pos + size])
+        pos += size
+        self._remaining -= size
+        if self._remaining == 0:
+          self._state = self._CHUNK_END if state == self._CHUNK_DATA else self._DONE
+      elif state == self._CLOSE_BODY:
+        self._bodySink(view[pos:])
+        pos = end
+      else:
+        # Fast paths for a header block or chunk framing that is whole in data.
+        if not self._partialLine:
+          if state == self._CHUNK_END and data.startswith(b'\r\n', pos):
+            pos += 2
+            self._state = self._CHUNK_SIZE
+            continue
+          if state == self._CHUNK_SIZE:
+            pos = self._feedChunks(data, view, pos, end)
+            continue
+          elif state == self._HEAD and self.response.code is None:
+            headEnd = data.find(b'\r\n\r\n', pos)
+            if headEnd >= 0:
+              self._processHead(data[pos:headEnd])
+              pos = headEnd + 4
+              continue
+        lineEnd = data.find(b'\n', pos)
+        if lineEnd < 0:
+          self._partialLine += view[pos:]
+          pos = end
+          break
+        if self._partialLine:
+          self._partialLine += view[pos:lineEnd + 1]
+          line = bytes(self._partialLine)
+          self._partialLine.clear()
+        else:
+          line = bytes(view[pos:lineEnd + 1])
+        pos = lineEnd + 1
+        self._processLine(line.rstrip(b'\r\n'))
+    if self._raw is not None:
+      self._raw += view[:pos]
+      if self._state == self._DONE:
+        self.response.raw = bytes(self._raw)
+    return bytes(view[pos:]) if pos < end else b''
+
+  def _feedChunks(self, data, view, pos, end):
+    '''Decodes the chunks starting at pos in one loop, as far as they are whole in data.
+
+    Returns: the position after the consumed bytes.'''
+    sink = self._bodySink
+    find = data.find
+    startswith = data.startswith
+    while True:
+      lineEnd = find(b'\n', pos)
+      if lineEnd < 0:
+        self._partialLine += view[pos:]
+        return end
+      # int ignores the surrounding whitespace, including the CR.
+      sizeLine = data[pos:lineEnd]
+      size = int(sizeLine.split(b';', 1)[0] if b';' in sizeLine else sizeLine, 16)
+      pos = lineEnd + 1
+      if size == 0:
+        if startswith(b'\r\n', pos):
+          self._state = self._DONE
+          return pos + 2
+        self._state = self._TRAILER
+        return pos
+      dataEnd = pos + size
+      if dataEnd + 2 > end:
+        self._remaining = size
+        self._state = self._CHUNK_DATA
+        return pos
+      sink(view[pos:dataEnd])
+      if not startswith(b'\r\n', dataEnd):
+        raise ValueError('Missing CRLF after chunk data')
+      pos = dataEnd + 2
+      if pos == end:
+        return pos
+
+  def finish(self):
+    '''Signals the end of the stream.'''
+    if self._state == self._CLOSE_BODY:
+      self._state = self._DONE
+      self.response.keepAlive = False
+      if self._raw is not None:
+        self.response.raw = bytes(self._raw)
+    if self._state != self._DONE:
+      raise IncompleteResponse()
+    return self.response
+
+  def _processHead(self, head):
+    '''Processes the status line and headers, without the empty line ending them.'''
+    statusLine, _, fields = head.partition(b'\r\n')
+    self._processStatusLine(statusLine)
+    if fields:
+      headers = self.response.headers
+      for line in fields.decode('latin-1').split('\r\n'):
+        name, _, value = line.partition(':')
+        headers.append((name.strip().lower(), value.strip()))
+    self._startBody()
+
+  def _processStatusLine(self, line):
+    m = self._statusLine.fullmatch(line)
+    if not m:
+      raise ValueError('Malformed status line {!r}'.format(line))
+    self.response.code = int(m.group(1))
+    self.response.message = m.group(2).decode('UTF-8', 'replace')
+
+  def _processLine(self, line):
+    response = self.response
+    state = self._state
+    if state == self._HEAD:
+      if response.code is None:
+        self._processStatusLine(line)
+      elif line:
+        name, _, value = line.partition(b':')
+        response.headers.append((name.strip().lower().decode('latin-1'), value.strip().decode('latin-1')))
+      else:
+        self._startBody()
+    elif state == self._CHUNK_SIZE:
+      self._remaining = int(line.split(b';', 1)[0], 16)
+      self._state = self._CHUNK_DATA if self._remaining else self._TRAILER
+    elif state == self._CHUNK_END:
+      if line:
+        raise ValueError('Missing CRLF after chunk data')
+      self._state = self._CHUNK_SIZE
+    elif state == self._TRAILER:
+      if not line:
+        self._state = self._DONE
+
+  def _startBody(self):
+    response = self.response
+    if response.getHeader('connection', '').lower() == 'close':
+      response.keepAlive = False
+    if response.code < 200 or response.code in (204, 304):
+      self._state = self._DONE
+    elif 'chunked' in response.getHeader('transfer-encoding', '').lower():
+      self._state = self._CHUNK_SIZE
+    elif response.getHeader('content-length') is not None:
+      self._remaining = int(response.getHeader('content-length'))
+      self._state = self._FIXED_BODY if self._remaining else self._DONE
+    else:
+      self._state = self._CLOSE_BODY
+
+def parseHTTPResponse(response):
+  '''Parses a complete raw response. Returns: HTTPResponse, whose raw is response itself.'''
+  parser = HTTPResponseParser(retainRaw = False)
+  parser.feed(response)
+  result = parser.finish()
+  result.raw = response
+  return result
+
+def parseHTTPHead(response):
+  '''Parses only the status line and headers of a raw response. Returns: HTTPResponse without body.'''
+  headEnd = response.find(b'\r\n\r\n')
+  if headEnd < 0:
+    raise IncompleteResponse()
+  parser = HTTPResponseParser(retainRaw = False)
+  parser._processHead(response[:headEnd])
+  return parser.response
+
+def _exchangeHTTPRequest(host, request, parser, pool = None, record = None):
+  '''Sends request over a pooled keep-alive connection and feeds the response to parser.
+
+  This is a generator yielding after every socket read, so the caller can consume the body while it
+  is still arriving. A connection taken from the pool may have been closed by the server while idle.
+  In that case the request is resent over another connection. Timings go to record if given.'''
+  if pool is None:
+    pool = defaultPool
+  clock = time.perf_counter
+  while True:
+    s, reused = pool.acquire(host, record)
+    try:
+      startTime = clock()
+      s.sendall(request)
+      sentTime = clock()
+      chunk = s.recv(1048576)
+      if not chunk:
+        raise StaleConnection()
+      break
+    except (StaleConnection, ConnectionResetError, BrokenPipeError) as e:
+      s.close()
+      if reused:
+        logger.debug('Stale connection to %s, reconnecting', host)
+        continue
+      if isinstance(e, StaleConnection):
+        raise ConnectionError('Server closed the connection without response.') from None
+      raise
+    except:
+      s.close()
+      raise
+  if record:
+    record.addPhase('send', sentTime - startTime)
+    record.addPhase('firstByte', clock() - sentTime)
+  try:
     while True:
+      startTime = clock()
+      if parser.feed(chunk):
+        # Unexpected trailing data; do not reuse the connection.
+        parser.response.keepAlive = False
+      if record:
+        record.wireBytes += len(chunk)
+        record.addPhase('dechunk', clock() - startTime)
+      if parser.done:
+        break
+      yield
+      startTime = clock()
       chunk = s.recv(1048576)
+      if record:
+        record.addPhase('receive', clock() - startTime)
       if not chunk:
+        parser.finish()
         break
-      rawChunks.append(chunk)
-    return b''.join(rawChunks)
+  except BaseException:
+    s.close()
+    raise
+  if parser.response.keepAlive:
+    pool.release(host, s)
+  else:
+    s.close()
+  yield
+
+def sendHTTPRequest(host, request, pool = None):
+  '''Returns: HTTPResponse.'''
+  parser = HTTPResponseParser()
+  for _ in _exchangeHTTPRequest(host, request, parser, pool):
+    pass
+  return parser.response
+
+def sendRawHTTPRequest(host, request, pool = None):
+  '''Returns: the raw response bytes.'''
+  return sendHTTPRequest(host, request, pool).raw
+
+class StreamingInflater:
+  '''Inflates a zlib stream as it arrives, optionally refusing to grow past maxSize bytes.'''
+
+  def __init__(self, maxSize = None):
+    self.maxSize = maxSize
+    self.size = 0
+    self.compressedSize = 0
+    self.elapsed = 0.0
+    self.output = bytearray()
+    self._decompressor = zlib.decompressobj()
+
+  def feed(self, data):
+    startTime = time.perf_counter()
+    self.compressedSize += len(data)
+    if self.maxSize is None:
+      inflated = self._decompressor.decompress(data)
+    else:
+      # Never inflate more than one byte past the limit, whatever the compression ratio.
+      inflated = self._decompressor.decompress(data, self.maxSize - self.size + 1)
+    self._append(inflated)
+    self.elapsed += time.perf_counter() - startTime
+
+  def finish(self):
+    self._append(self._decompressor.flush())
+    if not self._decompressor.eof:
+      raise zlib.error('Incomplete compressed stream')
+
+  def _append(self, inflated):
+    self.size += len(inflated)
+    if self.maxSize is not None and self.size > self.maxSize:
+      raise ResponseTooLarge(self.maxSize)
+    self.output += inflated
+
+class InflatingResponseParser(HTTPResponseParser):
+  '''Inflates the body of a 200 response while it arrives. Other bodies are collected as-is.'''
+
+  def __init__(self, maxSize = None):
+    self.inflater = StreamingInflater(maxSize)
+    super().__init__(retainRaw = False, bodySink = self._sink)
+
+  def _sink(self, data):
+    if self.response.code == 200:
+      self.inflater.feed(data)
+    else:
+      self.response.body += data
+
+  def complete(self):
+    '''Call once the response is done. Raises HTTPError for anything but 200.'''
+    response = self.response
+    if response.code != 200:
+      logger.debug('Error response body: %r', bytes(response.body))
+      raise HTTPError(response.code, response.message)
+    self.inflater.finish()
+
+def _inflateHTTPExchange(host, request, parser, pool, record = None):
+  try:
+    yield from _exchangeHTTPRequest(host, request, parser, pool, record)
+    parser.complete()
+  finally:
+    if record:
+      inflater = parser.inflater
+      # Inflating happens inside the parser, so take it out of the dechunk time.
+      record.addPhase('dechunk', -inflater.elapsed)
+      record.addPhase('inflate', inflater.elapsed)
+      record.compressedBytes += inflater.compressedSize
+      record.inflatedBytes += inflater.size
+  yield
+
+def streamDecompressedResponse(host, request, maxSize = None, pool = None):
+  '''Sends request and yields the inflated body in pieces as they come off the socket.
+
+  Neither the raw response nor the compressed body is kept in memory. Raises ResponseTooLarge once
+  more than maxSize bytes have been inflated.'''
+  parser = InflatingResponseParser(maxSize)
+  inflater = parser.inflater
+  for _ in _inflateHTTPExchange(host, request, parser, pool):
+    if inflater.output:
+      yield bytes(inflater.output)
+      inflater.output.clear()
+
+def fetchDecompressed(host, request, maxSize = None, pool = None, record = None):
+  '''Like streamDecompressedResponse, but collects the inflated body. Returns: bytearray.'''
+  parser = InflatingResponseParser(maxSize)
+  for _ in _inflateHTTPExchange(host, request, parser, pool, record):
+    pass
+  return parser.inflater.output
 
 def makeRequestString(command, t = None, gz = 1, market = 2, channel = 100012, version = client_version):
   if t is None:
@@ -99,7 +745,7 @@ def makeRequestString(command, t = None, gz = 1, market = 2, channel = 100012, v
 
 def makeHTTPRequest(host, command, cookie, t = None):
   requestString = makeRequestString(command, t)
-  return 'GET {} HTTP/1.1\r\nAccept-Encoding: identity\r\nCookie: {}\r\nUser-Agent: Dalvik/1.6.0 (Linux; U; Android 4.4.2; SM-G900F Build/KOT49H)\r\nHost: {}\r\nConnection: close\r\n\r\n'.format(requestString, cookie, host).encode('ASCII')
+  return 'GET {} HTTP/1.1\r\nAccept-Encoding: identity\r\nCookie: {}\r\nUser-Agent: Dalvik/1.6.0 (Linux; U; Android 4.4.2; SM-G900F Build/KOT49H)\r\nHost: {}\r\nConnection: keep-alive\r\n\r\n'.format(requestString, cookie, host).encode('ASCII')
 
 def makeHTTPRequestEx(method, host, command, cookie, contentType = None, content = None, t = None):
   fullQuery = makeRequestString(command, t)
@@ -107,9 +753,9 @@ def makeHTTPRequestEx(method, host, command, cookie, contentType = None, content
   request += 'Accept-Encoding: identity\r\n'
   if cookie:
     request += 'Cookie: {}\r\n'.format(cookie)
-  request += 'User-Agent: Dalvik/1.6.0 (Linux; U; Android 4.4.2; SM-G900F Build/KOT49H)\r\n'
+  request += 'User-Agent: {}\r\n'.format(user_agent)
   request += 'Host: {}\r\n'.format(host)
-  request += 'Connection: close\r\n'
+  request += 'Connection: keep-alive\r\n'
   if contentType:
     request += 'Content-Type: {}\r\n'.format(contentType)
   if content is not None:
@@ -119,51 +765,111 @@ def makeHTTPRequestEx(method, host, command, cookie, contentType = None, content
     request += content
   return request.encode('ASCII')
 
-assert(makeHTTPRequest('s5.jr.moefantasy.com',
-    '/dock/getBuildBoatLog/',
-    'hf_skey=1048056.1048056..1490440720.1.ade17b8423da87b4ffb4a03fd66f7966; path=/;QCLOUD=a',
-    1490440738502) ==
-  makeHTTPRequestEx('GET', 's5.jr.moefantasy.com', '/dock/getBuildBoatLog/',
-    'hf_skey=1048056.1048056..1490440720.1.ade17b8423da87b4ffb4a03fd66f7966; path=/;QCLOUD=a',
-    t = 1490440738502))
+def _logErrorResponse(raw):
+  logPath = 'error_response.{}.txt'.format(str(uuid.uuid1()))
+  with open(logPath, 'wb') as logFile:
+    logFile.write(raw)
 
 def dechunkHTTPResponse(response):
-  originalResponse = response
+  '''Accepts raw response bytes or an HTTPResponse. Returns: the body of a 200 response.'''
+  raw = response
   try:
-    header, response = response.split(b'\r\n\r\n', 1)
-    headerLines = header.split(b'\r\n')
-    responseCode, codeMessage = re.fullmatch(br'^HTTP/1\.1 ([0-9]+) (.*)$', headerLines[0]).group(1, 2)
-    responseCode = int(responseCode)
-    if responseCode != 200:
-      raise HTTPError(responseCode, codeMessage.decode('UTF-8'))
-    data = bytes()
-    while True:
-      [size, tail] = response.split(b'\r\n', 1)
-      size = int(size, 16)
-      if size == 0:
-        break
-      else:
-        data = data + tail[:size]
-        response = tail[size + 2:]  # skip CRLF
-    return data
+    if not isinstance(response, HTTPResponse):
+      response = parseHTTPResponse(response)
+    raw = response.raw
+    if response.code != 200:
+      raise HTTPError(response.code, response.message)
+    return response.body
   except Exception as e:
-    logPath = 'error_response.{}.txt'.format(str(uuid.uuid1()))
-    logFile = open(logPath, 'wb')
-    logFile.write(originalResponse)
-    logFile.close()
+    if raw is not None:
+      _logErrorResponse(raw)
     raise
 
 def decompressHTTPResponse(response):
   return zlib.decompress(dechunkHTTPResponse(response))
 
-def decodeHTTPResponse(response):
-  parsedResponse = json.loads(decompressHTTPResponse(response).decode('ASCII'), object_pairs_hook=collections.OrderedDict)
+class OrderedDecoder:
+  '''Decodes objects into OrderedDicts. This is the default.'''
+
+  def decode(self, data):
+    return json.loads(data, object_pairs_hook=collections.OrderedDict)
+
+class DictDecoder:
+  '''Decodes objects into plain dicts, which is considerably faster.'''
+
+  def decode(self, data):
+    return json.loads(data)
+
+class FastDecoder:
+  '''Decodes with orjson when it is installed, plain dicts otherwise.'''
+
+  def decode(self, data):
+    if orjson:
+      return orjson.loads(data)
+    return json.loads(data)
+
+class SelectiveDecoder:
+  '''Keeps only the given top-level keys of an object.
+
+  Top-level values are scanned one at a time with the C scanner of the json module, and values of
+  other keys are dropped as soon as they are built, so only the kept values stay referenced by the
+  result. Every value is still fully decoded, and the loop over top-level keys runs in Python, so
+  this is slower than DictDecoder; use it only to bound the memory a result holds on to. "eid" and
+  "code" are always kept so errors are still detected.'''
+
+  _whitespace = re.compile(r'[ \t\r\n]*')
+  _scanner = json.scanner.make_scanner(json.JSONDecoder())
+
+  def __init__(self, keys):
+    self.keys = frozenset(keys) | {'eid', 'code'}
+
+  def decode(self, data):
+    if not isinstance(data, str):
+      data = data.decode('UTF-8')
+    skipWhitespace = self._whitespace.match
+    result = {}
+    pos = skipWhitespace(data, 0).end()
+    self._expect(data, pos, '{')
+    pos = skipWhitespace(data, pos + 1).end()
+    if data.startswith('}', pos):
+      return result
+    while True:
+      self._expect(data, pos, '"')
+      key, pos = json.decoder.scanstring(data, pos + 1)
+      pos = skipWhitespace(data, pos).end()
+      self._expect(data, pos, ':')
+      pos = skipWhitespace(data, pos + 1).end()
+      try:
+        value, pos = self._scanner(data, pos)
+      except StopIteration:
+        raise ValueError('Expected value at {}'.format(pos)) from None
+      if key in self.keys:
+        result[key] = value
+      pos = skipWhitespace(data, pos).end()
+      if data.startswith('}', pos):
+        return result
+      self._expect(data, pos, ',')
+      pos = skipWhitespace(data, pos + 1).end()
+
+  def _expect(self, data, pos, token):
+    if not data.startswith(token, pos):
+      raise ValueError('Expected {!r} at {}'.format(token, pos))
+
+defaultDecoder = OrderedDecoder()
+
+def decodeJSON(data, decoder = None):
+  if decoder is None:
+    decoder = defaultDecoder
+  parsedResponse = decoder.decode(data)
   if 'eid' in parsedResponse:
     raise ServerError(parsedResponse['eid'])
   if 'code' in parsedResponse and int(parsedResponse['code'] < 0):
     raise ServerError(parsedResponse['code'])
   return parsedResponse
 
+def decodeHTTPResponse(response, decoder = None):
+  return decodeJSON(decompressHTTPResponse(response), decoder)
+
 def generateLoginRequestPass1(host, username, password):
   username = base64.b64encode(username.encode('UTF-8')).decode('ASCII')
   password = base64.b64encode(password.encode('UTF-8')).decode('ASCII')
@@ -171,65 +877,404 @@ def generateLoginRequestPass1(host, username, password):
   return makeHTTPRequestEx('POST', host, '/index/passportLogin/', None, 'application/x-www-form-urlencoded', formData)
 
 def pickCookieFromResponse(response):
-  headers = response.split(b'\r\n\r\n', 1)[0].split(b'\r\n')
+  if not isinstance(response, HTTPResponse):
+    response = parseHTTPHead(response)
   cookies = []
   uid = None
-  for header in headers:
-    m = re.match(br'^Set-Cookie: (([^;]+?)=([^;]+)).*$', header)
-    if m:
-      cookies.append(m.group(1))
-      if m.group(2) == b'hf_skey':
-        uid = m.group(3).split(b'.', 1)[0]
+  for header in response.getHeaders('set-cookie'):
+    cookie = header.split(';', 1)[0]
+    name, _, value = cookie.partition('=')
+    if not value:
+      continue
+    cookies.append(cookie)
+    if name == 'hf_skey':
+      uid = value.split('.', 1)[0]
   if not uid:
     raise ValueError('UID is not found in cookies.')
   uid = int(uid)
-  return (uid, b'; '.join(cookies).decode('ASCII'))
+  return (uid, '; '.join(cookies))
 
-def issueCommand(gameServer, command, cookie, retryCount = 2):
-  logger.info('Issuing command %s', command)
-  request = makeHTTPRequestEx('GET', gameServer, command, cookie)
-  for i in range(0, retryCount + 1):
+class RequestRecord:
+  '''What one issueCommand call spent its time on. Phase durations are in seconds and add up over
+  retries.'''
+
+  def __init__(self, host, command):
+    self.host = host
+    self.command = command
+    self.endpoint = '/'.join(command.split('?', 1)[0].split('/')[:3]).rstrip('/') + '/'
+    self.phases = collections.defaultdict(float)
+    self.wireBytes = 0
+    self.compressedBytes = 0
+    self.inflatedBytes = 0
+    self.retries = 0
+    self.outcome = None
+    self.totalTime = None
+
+  def addPhase(self, name, seconds):
+    self.phases[name] += seconds
+
+requestHooks = []
+
+def addRequestHook(hook):
+  '''hook is called with a RequestRecord after every issueCommand call, including those of
+  libzjsn_async, from the calling thread.'''
+  requestHooks.append(hook)
+
+def removeRequestHook(hook):
+  requestHooks.remove(hook)
+
+def _reportRequest(record):
+  for hook in list(requestHooks):
+    try:
+      hook(record)
+    except Exception:
+      logger.exception('Request hook failed')
+
+class HistogramCollector:
+  '''A request hook keeping a histogram of every phase per endpoint.
+
+  Bucket i counts durations up to 2 ** i microseconds.'''
+
+  def __init__(self):
+    self._lock = threading.Lock()
+    self.histograms = collections.defaultdict(collections.Counter)
+    self.totals = collections.defaultdict(float)
+    self.maxima = collections.defaultdict(float)
+    self.outcomes = collections.defaultdict(collections.Counter)
+
+  def __call__(self, record):
+    phases = dict(record.phases)
+    phases['total'] = record.totalTime
+    with self._lock:
+      self.outcomes[record.endpoint][record.outcome] += 1
+      for phase, seconds in phases.items():
+        key = (record.endpoint, phase)
+        micros = seconds * 1e6
+        self.histograms[key][max(0, math.ceil(math.log2(micros))) if micros > 1 else 0] += 1
+        self.totals[key] += seconds
+        self.maxima[key] = max(self.maxima[key], seconds)
+
+  def percentile(self, endpoint, phase, q):
+    '''Returns: an upper bound in seconds of the q-th percentile, or None without samples.'''
+    with self._lock:
+      histogram = dict(self.histograms[(endpoint, phase)])
+    count = sum(histogram.values())
+    if not count:
+      return None
+    seen = 0
+    for bucket in sorted(histogram):
+      seen += histogram[bucket]
+      if seen >= count * q / 100:
+        return 2 ** bucket / 1e6
+
+  def worstPhases(self, limit = 10):
+    '''Returns: up to limit (endpoint, phase, total seconds, max seconds), most total time first.'''
+    with self._lock:
+      rows = [(endpoint, phase, total, self.maxima[(endpoint, phase)])
+          for (endpoint, phase), total in self.totals.items() if phase != 'total']
+    rows.sort(key = lambda row: row[2], reverse = True)
+    return rows[:limit]
+
+class RetryPolicy:
+  '''Decides whether and when a failed command is retried.
+
+  The n-th retry waits a random time up to min(maxDelay, baseDelay * 2 ** (n - 1)), so threads failing
+  together do not retry together. Every command adds budgetRatio to a budget capped at budgetMax and
+  every retry takes 1 from it: while a server fails everything, retries stay around budgetRatio of the
+  command rate. Safe to share between threads.'''
+
+  def __init__(self, retryCount = 2, baseDelay = 0.5, maxDelay = 10, budgetRatio = 0.2, budgetMax = 10):
+    self.retryCount = retryCount
+    self.baseDelay = baseDelay
+    self.maxDelay = maxDelay
+    self.budgetRatio = budgetRatio
+    self.budgetMax = budgetMax
+    self._budget = budgetMax
+    self._lock = threading.Lock()
+
+  def shouldRetry(self, error):
+    if isinstance(error, HTTPError):
+      return error.code == 400
+    return isinstance(error, (socket.timeout, TimeoutError))
+
+  def onCommand(self):
+    with self._lock:
+      self._budget = min(self.budgetMax, self._budget + self.budgetRatio)
+
+  def backoff(self, command, attempt, retryCount, error):
+    '''Returns: seconds to wait after the attempt-th failure. Raises: RetriesExhausted.'''
+    if attempt > retryCount:
+      raise RetriesExhausted(command, attempt, error) from error
+    with self._lock:
+      if self._budget < 1:
+        raise RetriesExhausted(command, attempt, 'retry budget exhausted') from error
+      self._budget -= 1
+    return random.uniform(0, min(self.maxDelay, self.baseDelay * 2 ** (attempt - 1)))
+
+defaultRetryPolicy = RetryPolicy()
+
+class CircuitBreaker:
+  '''Fails fast while a server is down.
+
+  After failureThreshold failures in a row the circuit opens and check raises CircuitOpen. Once
+  resetTimeout has passed, one caller is let through as a probe: its success closes the circuit, its
+  failure opens it again. A probe that ends without an outcome, for example because it was cancelled,
+  must call abandonProbe so the next caller can probe. Safe to share between threads.'''
+
+  def __init__(self, host, failureThreshold = 5, resetTimeout = 30):
+    self.host = host
+    self.failureThreshold = failureThreshold
+    self.resetTimeout = resetTimeout
+    self.failures = 0
+    self.openUntil = None
+    self._probing = False
+    self._lock = threading.Lock()
+
+  def check(self):
+    '''Returns: True if the caller was let through as the probe. Raises: CircuitOpen.'''
+    with self._lock:
+      if self.openUntil is None:
+        return False
+      now = time.monotonic()
+      if self._probing or now < self.openUntil:
+        raise CircuitOpen(self.host, max(0, self.openUntil - now))
+      self._probing = True
+      return True
+
+  def abandonProbe(self):
+    '''Lets another caller probe, without counting the abandoned probe as a success or a failure.'''
+    with self._lock:
+      self._probing = False
+
+  def record(self, error = None):
+    '''Reports the outcome of a request let through by check. Only errors meaning the server struggles
+    (network errors, timeouts, HTTP 400 and 5xx) count as failures.'''
+    if isinstance(error, HTTPError):
+      failed = error.code == 400 or error.code >= 500
+    else:
+      failed = isinstance(error, OSError)
+    with self._lock:
+      if not failed:
+        if self.openUntil is not None:
+          logger.warning('Circuit to %s closed', self.host)
+        self.failures = 0
+        self.openUntil = None
+      else:
+        self.failures += 1
+        if self._probing or self.failures >= self.failureThreshold:
+          if self.openUntil is None:
+            logger.warning('Circuit to %s opened after %d failures', self.host, self.failures)
+          self.openUntil = time.monotonic() + self.resetTimeout
+      self._probing = False
+
+circuitBreakers = {}
+_circuitBreakersLock = threading.Lock()
+
+def getCircuitBreaker(host):
+  '''Returns: the CircuitBreaker shared by everything talking to host.'''
+  with _circuitBreakersLock:
+    breaker = circuitBreakers.get(host)
+    if breaker is None:
+      breaker = circuitBreakers[host] = CircuitBreaker(host)
+    return breaker
+
+class Session:
+  '''Talks to one game server as one user: host, cookie, connection pool and request template.
+
+  The header block is encoded once per cookie, so building a request only formats and signs the
+  query string.'''
+
+  def __init__(self, host, cookie = None, pool = None, retryPolicy = None):
+    self.host = host
+    self.pool = pool if pool else defaultPool
+    self.retryPolicy = retryPolicy if retryPolicy else defaultRetryPolicy
+    self.breaker = getCircuitBreaker(host)
+    self.cookie = cookie
+
+  @property
+  def cookie(self):
+    return self._template[0]
+
+  @cookie.setter
+  def cookie(self, cookie):
+    headers = ' HTTP/1.1\r\nAccept-Encoding: identity\r\n'
+    if cookie:
+      headers += 'Cookie: {}\r\n'.format(cookie)
+    headers += 'User-Agent: {}\r\nHost: {}\r\nConnection: keep-alive\r\n\r\n'.format(user_agent, self.host)
+    # Replaced as a whole so other threads never see a cookie with another cookie's headers.
+    self._template = (cookie, headers.encode('ASCII'))
+
+  def makeRequest(self, command, t = None):
+    '''Returns: the same bytes as makeHTTPRequestEx('GET', host, command, cookie, t = t).'''
+    return b'GET ' + makeRequestString(command, t).encode('ASCII') + self._template[1]
+
+  def issueCommand(self, command, retryCount = None, maxSize = None, decoder = None):
+    '''Retries timeouts and HTTP 400 as retryPolicy says; retryCount overrides its retryCount.
+
+    Raises: RetriesExhausted when no attempt succeeded, CircuitOpen while the server is failing.'''
+    logger.info('Issuing command %s', command)
+    policy = self.retryPolicy
+    if retryCount is None:
+      retryCount = policy.retryCount
+    record = RequestRecord(self.host, command)
+    startTime = time.perf_counter()
+    try:
+      request = self.makeRequest(command)
+      policy.onCommand()
+      attempt = 0
+      while True:
+        attempt += 1
+        probing = self.breaker.check()
+        try:
+          data = fetchDecompressed(self.host, request, maxSize, self.pool, record)
+        except Exception as e:
+          self.breaker.record(e)
+          if not policy.shouldRetry(e):
+            raise
+          logger.info('', exc_info = e)
+          record.outcome = 'HTTP {}'.format(e.code) if isinstance(e, HTTPError) else 'timeout'
+          delay = policy.backoff(command, attempt, retryCount, e)
+          logger.warning('Retry %d/%d in %.1fs...', attempt, retryCount, delay)
+          record.retries = attempt
+          record.addPhase('backoff', delay)
+          time.sleep(delay)
+          continue
+        except BaseException:
+          # A cancelled or interrupted probe says nothing about the server.
+          if probing:
+            self.breaker.abandonProbe()
+          raise
+        self.breaker.record()
+        logger.info('Command finish')
+        parseStartTime = time.perf_counter()
+        result = decodeJSON(data, decoder)
+        record.addPhase('parse', time.perf_counter() - parseStartTime)
+        record.outcome = 'ok'
+        return result
+    except Exception as e:
+      record.outcome = type(e).__name__
+      raise
+    finally:
+      record.totalTime = time.perf_counter() - startTime
+      if requestHooks:
+        _reportRequest(record)
+
+  def pipelineCommands(self, commands, maxSize = None):
+    '''Sends commands back to back over one keep-alive connection. Returns: list<map> in command order.
+
+    Only use this for read-only commands: a command whose response is lost (error status, connection
+    closed early) is issued again with issueCommand.'''
+    logger.info('Pipelining %d commands', len(commands))
+    requests = [self.makeRequest(command) for command in commands]
+    results = _pipelineRequests(self.host, requests, maxSize, self.pool)
+    responses = list()
+    for i, command in enumerate(commands):
+      if i < len(results) and not isinstance(results[i], HTTPError):
+        responses.append(decodeJSON(results[i]))
+      else:
+        responses.append(self.issueCommand(command, maxSize = maxSize))
+    logger.info('Pipeline finish')
+    return responses
+
+  def commandSeries(self, commands, interval, batched = False):
+    '''Returns: list<map>, a list of response data.
+
+    With batched set, the commands are pipelined and interval is ignored. See pipelineCommands.'''
+    if batched:
+      return self.pipelineCommands(commands)
+    isFirstOne = True
+    responses = list()
+    for command in commands:
+      if interval and not isFirstOne:
+        time.sleep(interval)
+      responses.append(self.issueCommand(command))
+      isFirstOne = False
+    return responses
+
+  def getExploreResult(self, exploreId):
+    data = self.issueCommand('/explore/getResult/{}/'.format(exploreId))
+    return checkExploreResult(data)
+
+  def startExplore(self, fleetId, exploreId):
+    data = self.issueCommand('/explore/start/{}/{}/'.format(fleetId, exploreId))
+    return checkStartExplore(data, exploreId)
+
+def issueCommand(gameServer, command, cookie, retryCount = None, maxSize = None, decoder = None):
+  return Session(gameServer, cookie).issueCommand(command, retryCount, maxSize, decoder)
+
+def _pipelineRequests(host, requests, maxSize, pool):
+  '''Writes all requests at once and reads the responses in order from the same connection.
+
+  Returns: a list with the inflated body or HTTPError of every response received. It may be shorter
+  than requests if the server closed the connection early.'''
+  while True:
+    s, reused = pool.acquire(host)
+    results = []
+    keepAlive = True
     try:
-      if i > 0:
-        logger.warning('Retry %d/%d...', i, retryCount)
-      response = sendRawHTTPRequest(gameServer, request)
-      logger.info('Command finish')
-      return decodeHTTPResponse(response)
-    except HTTPError as e:
-      logger.info('', exc_info = e)
-      if e.code != 400:
-        raise
-    except socket.timeout:
-      logger.info('', exc_info = True)
-    except TimeoutError:
-      logger.info('', exc_info = True)
-
-def commandSeries(gameServer, commands, cookie, interval):
-  '''Returns: list<map>, a list of response data.'''
-  isFirstOne = True
-  responses = list()
-  for command in commands:
-    if interval and not isFirstOne:
-      time.sleep(interval)
-    responses.append(issueCommand(gameServer, command, cookie))
-    isFirstOne = False
-  return responses
+      s.sendall(b''.join(requests))
+      parser = InflatingResponseParser(maxSize)
+      pending = b''
+      while len(results) < len(requests) and keepAlive:
+        if not pending:
+          pending = s.recv(1048576)
+          if not pending:
+            keepAlive = False
+            break
+        pending = parser.feed(pending)
+        if parser.done:
+          try:
+            parser.complete()
+            results.append(parser.inflater.output)
+          except HTTPError as e:
+            results.append(e)
+          keepAlive = parser.response.keepAlive
+          parser = InflatingResponseParser(maxSize)
+    except (ConnectionResetError, BrokenPipeError):
+      s.close()
+      if reused and not results:
+        logger.debug('Stale connection to %s, reconnecting', host)
+        continue
+      return results
+    except:
+      s.close()
+      raise
+    if reused and not results:
+      s.close()
+      logger.debug('Stale connection to %s, reconnecting', host)
+      continue
+    if keepAlive and not pending:
+      pool.release(host, s)
+    else:
+      s.close()
+    return results
+
+def pipelineCommands(gameServer, commands, cookie, maxSize = None, pool = None):
+  return Session(gameServer, cookie, pool).pipelineCommands(commands, maxSize)
+
+def commandSeries(gameServer, commands, cookie, interval, batched = False):
+  return Session(gameServer, cookie).commandSeries(commands, interval, batched)
 
 def loginPass1(host, username, password):
   '''Returns uid and cookie string.'''
   request = generateLoginRequestPass1(host, username, password)
-  response = sendRawHTTPRequest(host, request)
+  response = sendHTTPRequest(host, request)
   try:
     return pickCookieFromResponse(response)
   except ValueError as e:
     raise LoginError('Cookie extraction failure') from e
 
-def loginPass2(host, uid, cookie, version = client_version):
-  command = '/index/login/{}?&client_version={}&phone_type=SM-G900F&phone_version=4.4.2&ratio=1600*900&service=unknown&udid=nopermission&source=android&affiliate=WIFI'.format(uid, version)
-  data = issueCommand(host, command, cookie)
+def makeLoginPass2Command(uid, version = client_version):
+  return '/index/login/{}?&client_version={}&phone_type=SM-G900F&phone_version=4.4.2&ratio=1600*900&service=unknown&udid=nopermission&source=android&affiliate=WIFI'.format(uid, version)
+
+def checkLoginPass2(data):
   if 'loginStatus' not in data or data['loginStatus'] != 1:
     raise LoginError('Logging into game server failed. Response: ' + str(data))
 
+def loginPass2(host, uid, cookie, version = client_version):
+  data = issueCommand(host, makeLoginPass2Command(uid, version), cookie)
+  checkLoginPass2(data)
+
 def login(loginServer, gameServer, username, password):
   uid, cookie = loginPass1(loginServer, username, password)
   loginPass2(gameServer, uid, cookie)
@@ -239,7 +1284,7 @@ def register(loginServer, username, password, realName, realId):
   command = '/index/passportReg/{}/{}////?&realname={}&ID_card={}'.format(
       username, password, urllib.parse.quote_plus(realName, encoding = 'UTF-8'), realId)
   request = makeHTTPRequestEx('GET', loginServer, command, None)
-  response = sendRawHTTPRequest(loginServer, request)
+  response = sendHTTPRequest(loginServer, request)
   try:
     return (True, pickCookieFromResponse(response))
   except:
@@ -249,48 +1294,161 @@ def createCharacter(gameServer, cookie, name, startCid):
   command = '/api/regRole/{}/{}/'.format(
       urllib.parse.quote_plus(name, encoding = 'UTF-8'), startCid)
   request = makeHTTPRequestEx('GET', gameServer, command, cookie)
-  response = sendRawHTTPRequest(gameServer, request)
+  response = sendHTTPRequest(gameServer, request)
   data = decodeHTTPResponse(response)
   return data['status']
 
-def simulateMainScreen(gameServer, cookie):
-  return commandSeries(
-      gameServer,
-      [ '/bsea/getData/'
-      , '/live/getUserInfo'
-      , '/active/getUserData/'
-      , '/pve/getUserData/'
-      , '/campaign/getUserData/'
-      ],
-      cookie,
-      1
-  )
-
-def fullLogin(loginServer, gameServer, username, password):
-  '''Returns: (cookie, initGame, pveData, peventData, canBuy, bsea, userInfo, activeUserData, pveUserData, campaignUserData)'''
+mainScreenCommands = [
+    '/bsea/getData/',
+    '/live/getUserInfo',
+    '/active/getUserData/',
+    '/pve/getUserData/',
+    '/campaign/getUserData/',
+]
+
+fullLoginCommands = [
+    '/api/initGame?&crazy=1',
+    '/pve/getPveData/',
+    '/pevent/getPveData/',
+    '/shop/canBuy/1/',
+]
+
+def simulateMainScreen(gameServer, cookie, batched = False):
+  return commandSeries(gameServer, mainScreenCommands, cookie, 1, batched)
+
+def fullLogin(loginServer, gameServer, username, password, batched = False):
+  '''Returns: (cookie, initGame, pveData, peventData, canBuy, bsea, userInfo, activeUserData, pveUserData, campaignUserData)
+
+  With batched set, everything after the login itself is pipelined in one round trip instead of
+  being paced like the game client.'''
+  if not batched:
+    return _runSteps(fullLoginSteps(loginServer, gameServer, username, password))
   cookie = login(loginServer, gameServer, username, password)
-  initGame, pveData, peventData, canBuy = commandSeries(
-      gameServer,
-      [ '/api/initGame?&crazy=1'
-      , '/pve/getPveData/'
-      , '/pevent/getPveData/'
-      , '/shop/canBuy/1/'
-      ],
-      cookie,
-      1
-  )
-  time.sleep(1)
-  bsea, userInfo, activeUserData, pveUserData, campaignUserData = simulateMainScreen(gameServer, cookie)
+  initGame, pveData, peventData, canBuy, bsea, userInfo, activeUserData, pveUserData, campaignUserData = pipelineCommands(
+      gameServer, fullLoginCommands + mainScreenCommands, cookie)
   return (cookie, initGame, pveData, peventData, canBuy, bsea, userInfo, activeUserData, pveUserData, campaignUserData)
 
-def getExploreResult(gameServer, exploreId, cookie):
-  data = issueCommand(gameServer, '/explore/getResult/{}/'.format(exploreId), cookie)
+def fullLoginSteps(loginServer, gameServer, username, password):
+  '''fullLogin as a generator yielding the seconds to pause before each next command, so a scheduler
+  can pace several logins without blocking a thread. Returns: the same tuple as fullLogin.'''
+  cookie = login(loginServer, gameServer, username, password)
+  session = Session(gameServer, cookie)
+  results = []
+  for i, command in enumerate(fullLoginCommands + mainScreenCommands):
+    if i > 0:
+      yield 1
+    results.append(session.issueCommand(command))
+  return (cookie,) + tuple(results)
+
+def _runSteps(steps):
+  try:
+    while True:
+      time.sleep(next(steps))
+  except StopIteration as e:
+    return e.value
+
+class SessionCache:
+  '''Remembers login cookies in a JSON file, keyed by (login server, game server, username).
+
+  Entries older than maxAge seconds are ignored. The file is only readable by its owner and is
+  replaced atomically on every change. Where fcntl is available, changes are serialized by a lock on
+  path + '.lock', so processes may share the file. Failing to write it is logged, not raised: the
+  cache only saves logins.'''
+
+  def __init__(self, path = 'sessions.json', maxAge = 43200):
+    self.path = path
+    self.maxAge = maxAge
+    self._lock = threading.Lock()
+
+  def _load(self):
+    try:
+      with open(self.path, 'r', encoding = 'UTF-8') as f:
+        return json.load(f)
+    except (OSError, ValueError):
+      return {}
+
+  def _save(self, entries):
+    tempPath = '{}.{}.{}.tmp'.format(self.path, os.getpid(), threading.get_ident())
+    try:
+      with open(os.open(tempPath, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600), 'w', encoding = 'UTF-8') as f:
+        json.dump(entries, f, indent = 2)
+      os.replace(tempPath, self.path)
+    except OSError:
+      logger.warning('Cannot write session cache %s', self.path, exc_info = True)
+      with contextlib.suppress(OSError):
+        os.remove(tempPath)
+
+  @contextlib.contextmanager
+  def _locked(self):
+    '''Holds the lock of this object and, where fcntl is available, of the file across processes.'''
+    with self._lock:
+      if fcntl is None:
+        yield
+        return
+      fd = os.open(self.path + '.lock', os.O_RDWR | os.O_CREAT, 0o600)
+      try:
+        fcntl.flock(fd, fcntl.LOCK_EX)
+        yield
+      finally:
+        os.close(fd)
+
+  @staticmethod
+  def _key(loginServer, gameServer, username):
+    return json.dumps([loginServer, gameServer, username], ensure_ascii = False)
+
+  def get(self, loginServer, gameServer, username):
+    '''Returns: the cached cookie, or None if there is none or it is too old.'''
+    with self._lock:
+      entry = self._load().get(self._key(loginServer, gameServer, username))
+    if entry and time.time() - entry['time'] < self.maxAge:
+      return entry['cookie']
+    return None
+
+  def put(self, loginServer, gameServer, username, cookie):
+    with self._locked():
+      entries = self._load()
+      entries[self._key(loginServer, gameServer, username)] = {'cookie': cookie, 'time': time.time()}
+      self._save(entries)
+
+  def drop(self, loginServer, gameServer, username):
+    with self._locked():
+      entries = self._load()
+      if entries.pop(self._key(loginServer, gameServer, username), None) is not None:
+        self._save(entries)
+
+def resumeLogin(loginServer, gameServer, username, password, cache, batched = False):
+  '''fullLogin reusing the cookie cache holds for the account when the server still accepts it.
+
+  A cached cookie is tried by pipelining the login commands in one round trip. If the server rejects
+  it, this falls back to fullLogin and caches the new cookie. Returns: the same tuple as fullLogin.'''
+  return _runSteps(resumeLoginSteps(loginServer, gameServer, username, password, cache, batched))
+
+def resumeLoginSteps(loginServer, gameServer, username, password, cache, batched = False):
+  '''resumeLogin as a generator like fullLoginSteps. Returns: the same tuple as fullLogin.'''
+  cookie = cache.get(loginServer, gameServer, username)
+  if cookie:
+    try:
+      results = pipelineCommands(gameServer, fullLoginCommands + mainScreenCommands, cookie)
+      logger.info('Resumed cached session of %s', username)
+      # Restart the age of the entry, so a session in use does not expire from the cache.
+      cache.put(loginServer, gameServer, username, cookie)
+      return (cookie,) + tuple(results)
+    except ServerError as e:
+      logger.info('Cached session of %s rejected: %s', username, e)
+      cache.drop(loginServer, gameServer, username)
+  if batched:
+    result = fullLogin(loginServer, gameServer, username, password, batched)
+  else:
+    result = yield from fullLoginSteps(loginServer, gameServer, username, password)
+  cache.put(loginServer, gameServer, username, result[0])
+  return result
+
+def checkExploreResult(data):
   if 'bigSuccess' not in data:
     raise ValueError('Expected field "bigSuccess" not found in response.')
   return data
 
-def startExplore(gameServer, fleetId, exploreId, cookie):
-  data = issueCommand(gameServer, '/explore/start/{}/{}/'.format(fleetId, exploreId), cookie)
+def checkStartExplore(data, exploreId):
   if 'exploreId' not in data:
     raise ValueError('Expected field "exploreId" not found in response.')
   if int(data['exploreId']) != exploreId:
@@ -298,17 +1456,78 @@ def startExplore(gameServer, fleetId, exploreId, cookie):
         int(data['exploreId']), exploreId))
   return data
 
+def getExploreResult(gameServer, exploreId, cookie):
+  return Session(gameServer, cookie).getExploreResult(exploreId)
+
+def startExplore(gameServer, fleetId, exploreId, cookie):
+  return Session(gameServer, cookie).startExplore(fleetId, exploreId)
+
 def getCanonicalShipName(shipCid):
   return shipByCid[shipCid]['title']
 
+class Ship:
+  '''A userShipVO entry with the frequently used fields parsed once.
+
+  The entry itself is kept as compact JSON instead of a dict, which takes several times the memory.
+  Other fields are decoded on access, either through raw or by indexing the record itself.'''
+
+  __slots__ = ('id', 'cid', 'level', 'exp', 'nextExp', 'fleetId', 'hp', 'maxHp', '_packed')
+
+  def __init__(self, raw):
+    self._packed = json.dumps(raw, ensure_ascii = False, separators = (',', ':')).encode('UTF-8')
+    self.id = int(raw['id'])
+    self.cid = int(raw['shipCid'])
+    self.level = int(raw.get('level', 0))
+    self.exp = int(raw.get('exp', 0))
+    self.nextExp = int(raw.get('nextExp', 0))
+    self.fleetId = int(raw.get('fleetId', 0))
+    self.hp = int(raw['battleProps']['hp'])
+    self.maxHp = int(raw['battlePropsMax']['hp'])
+
+  @property
+  def raw(self):
+    '''A new dict decoded from the entry on every access.'''
+    return json.loads(self._packed.decode('UTF-8'))
+
+  def __getitem__(self, key):
+    return self.raw[key]
+
+  def __contains__(self, key):
+    return key in self.raw
+
+  def get(self, key, default = None):
+    return self.raw.get(key, default)
+
+class Fleet:
+  '''A fleetVo entry with its ship IDs parsed once.'''
+
+  __slots__ = ('id', 'shipIds', 'raw')
+
+  def __init__(self, raw):
+    self.raw = raw
+    self.id = int(raw['id'])
+    self.shipIds = [int(shipId) for shipId in raw['ships']]
+
+  def __getitem__(self, key):
+    return self.raw[key]
+
+  def __contains__(self, key):
+    return key in self.raw
+
+  def get(self, key, default = None):
+    return self.raw.get(key, default)
+
+def _getHp(ship):
+  if isinstance(ship, Ship):
+    return (ship.hp, ship.maxHp)
+  return (int(ship['battleProps']['hp']), int(ship['battlePropsMax']['hp']))
+
 def isHalfBroken(ship):
-  hp = int(ship['battleProps']['hp'])
-  maxHp = int(ship['battlePropsMax']['hp'])
+  hp, maxHp = _getHp(ship)
   assert(maxHp > 0)
   return hp * 2 < maxHp
 
 def isBroken(ship):
-  hp = int(ship['battleProps']['hp'])
-  maxHp = int(ship['battlePropsMax']['hp'])
+  hp, maxHp = _getHp(ship)
   assert(maxHp > 0)
   return hp * 4 < maxHp
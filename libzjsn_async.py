@@ -0,0 +1,250 @@
+'''asyncio versions of the libzjsn transport and command functions.
+
+Request building, response parsing, inflating and JSON decoding are shared with libzjsn; only the
+socket handling differs. Timeouts follow libzjsn.setSocketTimeout.'''
+
+import asyncio
+import collections
+import logging
+import socket
+import threading
+import time
+import weakref
+
+import libzjsn
+
+from libzjsn import HTTPError, HTTPResponseParser, InflatingResponseParser, LoginError, RequestRecord, StaleConnection
+
+logger = logging.getLogger('libzjsn.async')
+
+class ConnectionPool:
+  '''Keeps idle keep-alive streams per host. Must only be used from one event loop.'''
+
+  def __init__(self, maxIdlePerHost = 4, port = 80):
+    self.maxIdlePerHost = maxIdlePerHost
+    self.port = port
+    self._idle = collections.defaultdict(collections.deque)
+
+  async def acquire(self, host, record = None):
+    '''Returns: (reader, writer, reused).'''
+    idle = self._idle[host]
+    while idle:
+      reader, writer = idle.pop()
+      if not reader.at_eof():
+        return (reader, writer, True)
+      writer.close()
+    startTime = time.perf_counter()
+    reader, writer = await asyncio.wait_for(
+        asyncio.open_connection(host, self.port), socket.getdefaulttimeout())
+    if record:
+      # open_connection resolves and connects in one step.
+      record.addPhase('connect', time.perf_counter() - startTime)
+    return (reader, writer, False)
+
+  def release(self, host, reader, writer):
+    idle = self._idle[host]
+    if len(idle) < self.maxIdlePerHost:
+      idle.append((reader, writer))
+    else:
+      writer.close()
+
+  def clear(self):
+    for idle in self._idle.values():
+      for reader, writer in idle:
+        writer.close()
+    self._idle.clear()
+
+# Streams only work on the loop that opened them, so every event loop gets its own default pool.
+_defaultPools = weakref.WeakKeyDictionary()
+_defaultPoolsLock = threading.Lock()
+
+def getDefaultPool():
+  '''Returns: the default ConnectionPool of the running event loop.'''
+  loop = asyncio.get_running_loop()
+  with _defaultPoolsLock:
+    pool = _defaultPools.get(loop)
+    if pool is None:
+      # The idle streams of a pool refer to its loop, which is then never collected; drop pools of
+      # closed loops here instead.
+      for closedLoop in [other for other in _defaultPools if other.is_closed()]:
+        del _defaultPools[closedLoop]
+      pool = _defaultPools[loop] = ConnectionPool()
+    return pool
+
+async def _exchangeHTTPRequest(host, request, parser, pool = None, record = None):
+  '''Sends request and feeds the response to parser. Mirrors libzjsn._exchangeHTTPRequest.'''
+  if pool is None:
+    pool = getDefaultPool()
+  timeout = socket.getdefaulttimeout()
+  clock = time.perf_counter
+  while True:
+    reader, writer, reused = await pool.acquire(host, record)
+    try:
+      startTime = clock()
+      writer.write(request)
+      await asyncio.wait_for(writer.drain(), timeout)
+      sentTime = clock()
+      chunk = await asyncio.wait_for(reader.read(1048576), timeout)
+      if not chunk:
+        raise StaleConnection()
+      break
+    except (StaleConnection, ConnectionResetError, BrokenPipeError) as e:
+      writer.close()
+      if reused:
+        logger.debug('Stale connection to %s, reconnecting', host)
+        continue
+      if isinstance(e, StaleConnection):
+        raise ConnectionError('Server closed the connection without response.') from None
+      raise
+    except BaseException:
+      writer.close()
+      raise
+  if record:
+    record.addPhase('send', sentTime - startTime)
+    record.addPhase('firstByte', clock() - sentTime)
+  try:
+    while True:
+      startTime = clock()
+      if parser.feed(chunk):
+        parser.response.keepAlive = False
+      if record:
+        record.wireBytes += len(chunk)
+        record.addPhase('dechunk', clock() - startTime)
+      if parser.done:
+        break
+      startTime = clock()
+      chunk = await asyncio.wait_for(reader.read(1048576), timeout)
+      if record:
+        record.addPhase('receive', clock() - startTime)
+      if not chunk:
+        parser.finish()
+        break
+  except BaseException:
+    writer.close()
+    raise
+  if parser.response.keepAlive:
+    pool.release(host, reader, writer)
+  else:
+    writer.close()
+
+async def sendHTTPRequest(host, request, pool = None):
+  '''Returns: libzjsn.HTTPResponse.'''
+  parser = HTTPResponseParser()
+  await _exchangeHTTPRequest(host, request, parser, pool)
+  return parser.response
+
+async def fetchDecompressed(host, request, maxSize = None, pool = None, record = None):
+  '''Returns: the inflated body as a bytearray.'''
+  parser = InflatingResponseParser(maxSize)
+  try:
+    await _exchangeHTTPRequest(host, request, parser, pool, record)
+    parser.complete()
+  finally:
+    if record:
+      inflater = parser.inflater
+      # Inflating happens inside the parser, so take it out of the dechunk time.
+      record.addPhase('dechunk', -inflater.elapsed)
+      record.addPhase('inflate', inflater.elapsed)
+      record.compressedBytes += inflater.compressedSize
+      record.inflatedBytes += inflater.size
+  return parser.inflater.output
+
+async def issueCommand(gameServer, command, cookie, retryCount = None, maxSize = None, decoder = None, retryPolicy = None,
+    pool = None):
+  '''Retries like libzjsn.Session.issueCommand, sharing its circuit breakers and request hooks.'''
+  logger.info('Issuing command %s', command)
+  policy = retryPolicy if retryPolicy else libzjsn.defaultRetryPolicy
+  if retryCount is None:
+    retryCount = policy.retryCount
+  breaker = libzjsn.getCircuitBreaker(gameServer)
+  record = RequestRecord(gameServer, command)
+  startTime = time.perf_counter()
+  try:
+    request = libzjsn.makeHTTPRequestEx('GET', gameServer, command, cookie)
+    policy.onCommand()
+    attempt = 0
+    while True:
+      attempt += 1
+      probing = breaker.check()
+      try:
+        data = await fetchDecompressed(gameServer, request, maxSize, pool, record)
+      except Exception as e:
+        breaker.record(e)
+        if not policy.shouldRetry(e):
+          raise
+        logger.info('', exc_info = e)
+        record.outcome = 'HTTP {}'.format(e.code) if isinstance(e, HTTPError) else 'timeout'
+        delay = policy.backoff(command, attempt, retryCount, e)
+        logger.warning('Retry %d/%d in %.1fs...', attempt, retryCount, delay)
+        record.retries = attempt
+        record.addPhase('backoff', delay)
+        await asyncio.sleep(delay)
+        continue
+      except BaseException:
+        # A cancelled or interrupted probe says nothing about the server.
+        if probing:
+          breaker.abandonProbe()
+        raise
+      breaker.record()
+      logger.info('Command finish')
+      parseStartTime = time.perf_counter()
+      result = libzjsn.decodeJSON(data, decoder)
+      record.addPhase('parse', time.perf_counter() - parseStartTime)
+      record.outcome = 'ok'
+      return result
+  except BaseException as e:
+    record.outcome = type(e).__name__
+    raise
+  finally:
+    record.totalTime = time.perf_counter() - startTime
+    if libzjsn.requestHooks:
+      libzjsn._reportRequest(record)
+
+async def commandSeries(gameServer, commands, cookie, interval):
+  '''Returns: list<map>, a list of response data.'''
+  isFirstOne = True
+  responses = list()
+  for command in commands:
+    if interval and not isFirstOne:
+      await asyncio.sleep(interval)
+    responses.append(await issueCommand(gameServer, command, cookie))
+    isFirstOne = False
+  return responses
+
+async def loginPass1(host, username, password):
+  '''Returns uid and cookie string.'''
+  request = libzjsn.generateLoginRequestPass1(host, username, password)
+  response = await sendHTTPRequest(host, request)
+  try:
+    return libzjsn.pickCookieFromResponse(response)
+  except ValueError as e:
+    raise LoginError('Cookie extraction failure') from e
+
+async def loginPass2(host, uid, cookie, version = libzjsn.client_version):
+  data = await issueCommand(host, libzjsn.makeLoginPass2Command(uid, version), cookie)
+  libzjsn.checkLoginPass2(data)
+
+async def login(loginServer, gameServer, username, password):
+  uid, cookie = await loginPass1(loginServer, username, password)
+  await loginPass2(gameServer, uid, cookie)
+  return cookie
+
+async def simulateMainScreen(gameServer, cookie):
+  return await commandSeries(gameServer, libzjsn.mainScreenCommands, cookie, 1)
+
+async def fullLogin(loginServer, gameServer, username, password):
+  '''Returns: (cookie, initGame, pveData, peventData, canBuy, bsea, userInfo, activeUserData, pveUserData, campaignUserData)'''
+  cookie = await login(loginServer, gameServer, username, password)
+  initGame, pveData, peventData, canBuy = await commandSeries(
+      gameServer, libzjsn.fullLoginCommands, cookie, 1)
+  await asyncio.sleep(1)
+  bsea, userInfo, activeUserData, pveUserData, campaignUserData = await simulateMainScreen(gameServer, cookie)
+  return (cookie, initGame, pveData, peventData, canBuy, bsea, userInfo, activeUserData, pveUserData, campaignUserData)
+
+async def getExploreResult(gameServer, exploreId, cookie):
+  data = await issueCommand(gameServer, '/explore/getResult/{}/'.format(exploreId), cookie)
+  return libzjsn.checkExploreResult(data)
+
+async def startExplore(gameServer, fleetId, exploreId, cookie):
+  data = await issueCommand(gameServer, '/explore/start/{}/{}/'.format(fleetId, exploreId), cookie)
+  return libzjsn.checkStartExplore(data, exploreId)
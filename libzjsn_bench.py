@@ -0,0 +1,134 @@
+#!/usr/bin/python3
+
+import argparse
+import json
+import random
+import sys
+import time
+import tracemalloc
+import zlib
+
+import libzjsn
+
+cookie = 'hf_skey=1048056.1048056..1490440720.1.ade17b8423da87b4ffb4a03fd66f7966; QCLOUD=a'
+
+def makeShip(i):
+  return {
+    'id': str(10000 + i), 'shipCid': str(10000000 + i % 300 * 100), 'title': 'Ship {}'.format(i),
+    'level': str(random.randint(1, 110)), 'exp': str(random.randint(0, 100000)), 'fleetId': str(i % 9),
+    'battleProps': {'hp': random.randint(1, 100), 'atk': 50, 'def': 40, 'torpedo': 30},
+    'battlePropsMax': {'hp': 100, 'atk': 50, 'def': 40, 'torpedo': 30},
+    'equipment': [random.randint(0, 100000) for _ in range(4)], 'skillId': str(i % 50),
+  }
+
+def makeInitGame(numShips = 1000):
+  return {
+    'userShipVO': [makeShip(i) for i in range(numShips)],
+    'fleetVo': [{'id': str(i), 'title': 'Fleet {}'.format(i), 'ships': [str(10000 + j) for j in range(i * 6, i * 6 + 6)]}
+        for i in range(1, 9)],
+    'pveExploreVo': {'levels': [{'exploreId': str(i), 'fleetId': str(i), 'endTime': 1500000000} for i in range(4)]},
+    'systime': 1500000000,
+  }
+
+def makeBuildLog(numEntries = 30):
+  return {'log': [{'id': 1000000 + i, 'uid': 200000 + i, 'username': 'user{}'.format(i), 'createTime': 1500000000 + i,
+      'cid': 10000000 + i % 300 * 100, 'type': 1, 'res': {'oil': 400, 'ammo': 100, 'steel': 400, 'aluminium': 100}}
+      for i in range(numEntries)]}
+
+def makeDealto():
+  return {'warReport': {'canDoNightWar': 1,
+      'hpBeforeNightWarSelf': [random.randint(1, 100) for _ in range(6)],
+      'hpBeforeNightWarEnemy': [random.randint(1, 100) for _ in range(6)],
+      'selfShips': [makeShip(i) for i in range(6)], 'enemyShips': [makeShip(i) for i in range(6)],
+      'attacks': [{'from': i % 6, 'target': [i % 6], 'damage': [random.randint(0, 100)]} for i in range(60)]}}
+
+def makeRawResponse(document, numChunks):
+  body = zlib.compress(json.dumps(document).encode('ASCII'))
+  chunkSize = max(1, -(-len(body) // numChunks))
+  parts = [b'HTTP/1.1 200 OK\r\nServer: nginx\r\nContent-Type: text/html\r\nTransfer-Encoding: chunked\r\n'
+      b'Connection: keep-alive\r\nSet-Cookie: hf_skey=1048056.1048056..1490440720.1.ade1; path=/\r\n'
+      b'Set-Cookie: QCLOUD=a; path=/\r\n\r\n']
+  for i in range(0, len(body), chunkSize):
+    chunk = body[i:i + chunkSize]
+    parts.append('{:x}\r\n'.format(len(chunk)).encode('ASCII') + chunk + b'\r\n')
+  parts.append(b'0\r\n\r\n')
+  return b''.join(parts)
+
+def measure(function, minTime):
+  '''Returns: (operations per second, peak traced bytes of one operation).'''
+  function()
+  count = 0
+  start = time.perf_counter()
+  while True:
+    function()
+    count += 1
+    elapsed = time.perf_counter() - start
+    if elapsed >= minTime:
+      break
+  tracemalloc.start()
+  function()
+  peak = tracemalloc.get_traced_memory()[1]
+  tracemalloc.stop()
+  return (count / elapsed, peak)
+
+def makeCases():
+  random.seed(1)
+  cases = [
+    ('makeRequestString', 0, lambda: libzjsn.makeRequestString('/dock/getBuildBoatLog/')),
+    ('makeHTTPRequestEx', 0, lambda: libzjsn.makeHTTPRequestEx('GET', 's5.jr.moefantasy.com', '/dock/getBuildBoatLog/', cookie)),
+    ('Session.makeRequest', 0, lambda session = libzjsn.Session('s5.jr.moefantasy.com', cookie):
+        session.makeRequest('/dock/getBuildBoatLog/')),
+  ]
+  documents = [('initGame', makeInitGame()), ('getBuildBoatLog', makeBuildLog()), ('dealto', makeDealto())]
+  for name, document in documents:
+    for numChunks in [1, 16, 256]:
+      raw = makeRawResponse(document, numChunks)
+      suffix = '[{},{}]'.format(name, numChunks)
+      cases += [
+        ('dechunkHTTPResponse' + suffix, len(raw), lambda raw = raw: libzjsn.dechunkHTTPResponse(raw)),
+        ('decompressHTTPResponse' + suffix, len(raw), lambda raw = raw: libzjsn.decompressHTTPResponse(raw)),
+        ('decodeHTTPResponse' + suffix, len(raw), lambda raw = raw: libzjsn.decodeHTTPResponse(raw)),
+      ]
+    raw = makeRawResponse(document, 16)
+    cases.append(('pickCookieFromResponse[{}]'.format(name), len(raw), lambda raw = raw: libzjsn.pickCookieFromResponse(raw)))
+  return cases
+
+def compare(results, baseline, tolerance):
+  '''Returns: names of cases that got slower than the baseline by more than tolerance.'''
+  regressions = []
+  for name, result in results.items():
+    if name in baseline and result['opsPerSecond'] < baseline[name]['opsPerSecond'] * (1 - tolerance):
+      regressions.append(name)
+  return regressions
+
+def main():
+  parser = argparse.ArgumentParser(description = 'Micro-benchmarks of the libzjsn request/response codec.')
+  parser.add_argument('--min-time', type = float, default = 0.5, help = 'Seconds to run every case')
+  parser.add_argument('--filter', default = '', help = 'Only run cases containing this string')
+  parser.add_argument('--output', help = 'Write results to this JSON file')
+  parser.add_argument('--compare', help = 'Baseline JSON file written by --output')
+  parser.add_argument('--tolerance', type = float, default = 0.1, help = 'Allowed slowdown against the baseline')
+  args = parser.parse_args()
+
+  results = {}
+  for name, size, function in makeCases():
+    if args.filter not in name:
+      continue
+    opsPerSecond, peak = measure(function, args.min_time)
+    results[name] = {'opsPerSecond': opsPerSecond, 'bytes': size, 'peakBytesPerOp': peak}
+    throughput = ', {:.1f} MB/s'.format(opsPerSecond * size / 1e6) if size else ''
+    print('{:50} {:12.0f} ops/s{}, peak {} bytes/op'.format(name, opsPerSecond, throughput, peak))
+
+  if args.output:
+    with open(args.output, 'w', encoding = 'UTF-8') as f:
+      json.dump(results, f, indent = 2)
+  if args.compare:
+    with open(args.compare, 'r', encoding = 'UTF-8') as f:
+      regressions = compare(results, json.load(f), args.tolerance)
+    for name in regressions:
+      print('Regression: {}'.format(name))
+    if regressions:
+      sys.exit(1)
+
+if __name__ == '__main__':
+  main()
@@ -1,6 +1,24 @@
 # encoding: UTF-8
 
+import asyncio
+import importlib.util
+import json
+import os
+import random
+import shutil
+import socket
+import sys
+import tempfile
+import threading
+import time
+import traceback
+import zlib
+
+import challenge_lib
 import libzjsn
+import libzjsn_async
+
+from client import BasicClient
 
 libzjsn.loadConfig()
 
@@ -14,7 +32,466 @@ def testServerErrorUnknown():
   assert(error.errorCode == -7654)
   assert(error.message == "Unknown error -7654")
 
-cases = [testServerErrorKnown, testServerErrorUnknown]
+def testMakeHTTPRequest():
+  cookie = 'hf_skey=1048056.1048056..1490440720.1.ade17b8423da87b4ffb4a03fd66f7966; path=/;QCLOUD=a'
+  assert(libzjsn.makeHTTPRequest('s5.jr.moefantasy.com', '/dock/getBuildBoatLog/', cookie, 1490440738502) ==
+      libzjsn.makeHTTPRequestEx('GET', 's5.jr.moefantasy.com', '/dock/getBuildBoatLog/', cookie, t = 1490440738502))
+  session = libzjsn.Session('s5.jr.moefantasy.com')
+  for c in [None, cookie]:
+    session.cookie = c
+    assert(session.makeRequest('/dock/getBuildBoatLog/', 1490440738502) ==
+        libzjsn.makeHTTPRequestEx('GET', 's5.jr.moefantasy.com', '/dock/getBuildBoatLog/', c, t = 1490440738502))
+
+chunkedResponse = (b'HTTP/1.1 200 OK\r\nTransfer-Encoding: chunked\r\n'
+    b'Set-Cookie: hf_skey=1048056.1048056..1490440720.1.ade1; path=/\r\nSet-Cookie: QCLOUD=a; path=/\r\n\r\n'
+    b'3\r\nabc\r\n4\r\ndefg\r\n0\r\n\r\n')
+
+def testParseChunkedResponse():
+  for step in [1, 2, 5, len(chunkedResponse)]:
+    parser = libzjsn.HTTPResponseParser()
+    for i in range(0, len(chunkedResponse), step):
+      parser.feed(chunkedResponse[i:i + step])
+    assert(parser.done)
+    assert(parser.response.code == 200)
+    assert(parser.response.body == b'abcdefg')
+    assert(parser.response.raw == chunkedResponse)
+
+def testParseHTTPResponse():
+  response = libzjsn.parseHTTPResponse(chunkedResponse)
+  assert(response.raw is chunkedResponse)
+  assert(response.body == b'abcdefg' and response.getHeader('transfer-encoding') == 'chunked')
+  assert(len(response.getHeaders('set-cookie')) == 2)
+  extended = b'HTTP/1.1 200 OK\r\nTRANSFER-ENCODING:  Chunked \r\n\r\n3;name=value\r\nabc\r\n0\r\nTrailer: x\r\n\r\n'
+  assert(libzjsn.parseHTTPResponse(extended).body == b'abc')
+  fixed = b'HTTP/1.1 404 Not Found\r\nContent-Length: 4\r\nConnection: close\r\n\r\nnope'
+  response = libzjsn.parseHTTPResponse(fixed)
+  assert(response.code == 404 and response.body == b'nope' and not response.keepAlive)
+
+def testPickCookie():
+  uid, cookie = libzjsn.pickCookieFromResponse(chunkedResponse)
+  assert(uid == 1048056)
+  assert(cookie == 'hf_skey=1048056.1048056..1490440720.1.ade1; QCLOUD=a')
+
+def testSelectiveDecoder():
+  decoder = libzjsn.SelectiveDecoder(['log'])
+  data = b'{"skipped": [{"a": "]}"}, 1], "log": [{"id": 3}], "code": 0}'
+  assert(decoder.decode(data) == {'log': [{'id': 3}], 'code': 0})
+
+class FakeClock:
+  '''Stands in for the time and random modules of libzjsn.'''
+
+  def __init__(self):
+    self.now = 1000.0
+
+  def monotonic(self):
+    return self.now
+
+  def uniform(self, low, high):
+    return high
+
+def withFakeClock(function):
+  clock = FakeClock()
+  realTime, realRandom = libzjsn.time, libzjsn.random
+  libzjsn.time = libzjsn.random = clock
+  try:
+    function(clock)
+  finally:
+    libzjsn.time, libzjsn.random = realTime, realRandom
+
+def testRetryPolicy():
+  def run(clock):
+    policy = libzjsn.RetryPolicy(retryCount = 5, baseDelay = 0.5, maxDelay = 3, budgetRatio = 0.5, budgetMax = 3)
+    error = libzjsn.HTTPError(400, 'Bad Request')
+    assert(policy.shouldRetry(error))
+    assert(not policy.shouldRetry(libzjsn.HTTPError(500, 'Internal Server Error')))
+    assert([policy.backoff('/a/', attempt, 5, error) for attempt in [1, 2, 3]] == [0.5, 1, 2])
+    # The budget of 3 is used up.
+    try:
+      policy.backoff('/a/', 4, 5, error)
+      assert(False)
+    except libzjsn.RetriesExhausted as e:
+      assert(e.attempts == 4)
+    policy.onCommand()
+    policy.onCommand()
+    assert(policy.backoff('/a/', 4, 5, error) == 3)
+    try:
+      policy.backoff('/a/', 6, 5, error)
+      assert(False)
+    except libzjsn.RetriesExhausted as e:
+      assert(e.attempts == 6)
+  withFakeClock(run)
+
+def expectCircuitOpen(breaker):
+  try:
+    breaker.check()
+    assert(False)
+  except libzjsn.CircuitOpen as e:
+    return e.retryAfter
+
+def testCircuitBreaker():
+  def run(clock):
+    breaker = libzjsn.CircuitBreaker('s5.jr.moefantasy.com', failureThreshold = 3, resetTimeout = 30)
+    for i in range(2):
+      breaker.check()
+      breaker.record(OSError())
+    # A client error is an answer from a working server and resets the count.
+    breaker.check()
+    breaker.record(libzjsn.HTTPError(404, 'Not Found'))
+    for error in [OSError(), libzjsn.HTTPError(502, 'Bad Gateway'), libzjsn.HTTPError(400, 'Bad Request')]:
+      breaker.check()
+      breaker.record(error)
+    assert(expectCircuitOpen(breaker) == 30)
+    clock.now += 20
+    assert(expectCircuitOpen(breaker) == 10)
+    # Only one probe is let through; its failure opens the circuit again.
+    clock.now += 10
+    breaker.check()
+    assert(expectCircuitOpen(breaker) == 0)
+    breaker.record(OSError())
+    assert(expectCircuitOpen(breaker) == 30)
+    # A successful probe closes it.
+    clock.now += 30
+    breaker.check()
+    breaker.record()
+    breaker.check()
+    assert(breaker.failures == 0 and breaker.openUntil is None)
+  withFakeClock(run)
+
+class EvenFleetMatcher(challenge_lib.Matcher):
+  def apply(self, enemyFleetId, enemyShips):
+    return enemyFleetId % 2 == 0
+
+def applyRulesLinearly(rules, enemyFleetId, enemyShips):
+  for matcher, formation in rules:
+    if matcher.apply(enemyFleetId, enemyShips):
+      return formation
+  return 0
+
+def testCircuitBreakerCancelledProbe():
+  host = '127.0.0.1'
+  breaker = libzjsn.circuitBreakers[host] = libzjsn.CircuitBreaker(host, failureThreshold = 1, resetTimeout = 0)
+  # Connections are accepted by the kernel but never answered.
+  listener = socket.socket()
+  try:
+    listener.bind((host, 0))
+    listener.listen(8)
+    pool = libzjsn_async.ConnectionPool(port = listener.getsockname()[1])
+    breaker.record(OSError())
+    try:
+      asyncio.run(asyncio.wait_for(libzjsn_async.issueCommand(host, '/a/', None, pool = pool), 0.3))
+      assert(False)
+    except asyncio.TimeoutError:
+      pass
+    # The cancelled probe neither closed nor reopened the circuit, and the next caller may probe.
+    assert(breaker.failures == 1)
+    assert(breaker.check())
+  finally:
+    listener.close()
+    del libzjsn.circuitBreakers[host]
+
+def testAsyncDefaultPoolPerLoop():
+  async def getPools():
+    return (libzjsn_async.getDefaultPool(), libzjsn_async.getDefaultPool())
+  first, again = asyncio.run(getPools())
+  assert(first is again)
+  second, again = asyncio.run(getPools())
+  assert(second is not first)
+
+def testSessionCacheSharedFile():
+  directory = tempfile.mkdtemp()
+  try:
+    path = os.path.join(directory, 'sessions.json')
+    # Separate instances share nothing but the file, like separate processes.
+    caches = [libzjsn.SessionCache(path) for i in range(4)]
+    def putMany(i):
+      for j in range(50):
+        caches[i].put('login', 'game', 'user{}.{}'.format(i, j), 'cookie{}'.format(j))
+    threads = [threading.Thread(target = putMany, args = (i,)) for i in range(len(caches))]
+    for thread in threads:
+      thread.start()
+    for thread in threads:
+      thread.join()
+    for i in range(len(caches)):
+      for j in range(50):
+        assert(caches[0].get('login', 'game', 'user{}.{}'.format(i, j)) == 'cookie{}'.format(j))
+  finally:
+    shutil.rmtree(directory)
+
+class FakeServer:
+  '''Serves HTTP on a local port from a background thread.
+
+  handler is called with (request, connection number, request number on that connection) and
+  returns the response bytes, or None to close the connection without answering.'''
+
+  def __init__(self, handler):
+    self.handler = handler
+    self.connections = 0
+    self.requests = []
+    # Connections the client closed, as seen by the server.
+    self.closedByClient = 0
+    self._listener = socket.socket()
+    self._listener.bind(('127.0.0.1', 0))
+    self._listener.listen(8)
+    self.port = self._listener.getsockname()[1]
+    threading.Thread(target = self._accept, daemon = True).start()
+
+  def _accept(self):
+    while True:
+      try:
+        connection, address = self._listener.accept()
+      except OSError:
+        return
+      self.connections += 1
+      threading.Thread(target = self._serve, args = (connection, self.connections), daemon = True).start()
+
+  def _serve(self, connection, connectionNumber):
+    with connection:
+      buffer = b''
+      requestNumber = 0
+      while True:
+        while b'\r\n\r\n' not in buffer:
+          data = connection.recv(65536)
+          if not data:
+            self.closedByClient += 1
+            return
+          buffer += data
+        request, buffer = buffer.split(b'\r\n\r\n', 1)
+        requestNumber += 1
+        self.requests.append((connectionNumber, commandOf(request)))
+        response = self.handler(request, connectionNumber, requestNumber)
+        if response is None:
+          # Send FIN before closing, so unread requests do not turn the close into a reset.
+          connection.shutdown(socket.SHUT_WR)
+          return
+        connection.sendall(response)
+
+  def close(self):
+    self._listener.close()
+
+def makeResponse(document, numChunks = 3):
+  body = zlib.compress(json.dumps(document).encode('ASCII'))
+  chunkSize = max(1, -(-len(body) // numChunks))
+  parts = [b'HTTP/1.1 200 OK\r\nTransfer-Encoding: chunked\r\n\r\n']
+  for i in range(0, len(body), chunkSize):
+    chunk = body[i:i + chunkSize]
+    parts.append('{:x}\r\n'.format(len(chunk)).encode('ASCII') + chunk + b'\r\n')
+  parts.append(b'0\r\n\r\n')
+  return b''.join(parts)
+
+def commandOf(request):
+  return request.split(b' ', 2)[1].split(b'&', 1)[0].decode('ASCII')
+
+def testAsyncRequestHooks():
+  server = FakeServer(lambda request, connection, number: makeResponse({'command': commandOf(request)}))
+  records = []
+  libzjsn.addRequestHook(records.append)
+  try:
+    pool = libzjsn_async.ConnectionPool(port = server.port)
+    result = asyncio.run(libzjsn_async.issueCommand('127.0.0.1', '/dock/getBuildBoatLog/', None, pool = pool))
+    assert(result == {'command': '/dock/getBuildBoatLog/'})
+  finally:
+    libzjsn.removeRequestHook(records.append)
+    server.close()
+  assert(len(records) == 1)
+  record = records[0]
+  assert(record.endpoint == '/dock/getBuildBoatLog/' and record.outcome == 'ok' and record.retries == 0)
+  assert(record.wireBytes > record.compressedBytes > 0 and record.inflatedBytes > 0)
+  assert(set(record.phases) >= {'connect', 'send', 'firstByte', 'dechunk', 'inflate', 'parse'})
+
+def testPipelineReissuesLostResponses():
+  # The first connection answers two of the four pipelined requests and closes.
+  server = FakeServer(lambda request, connection, number:
+      None if connection == 1 and number == 3 else makeResponse({'command': commandOf(request)}))
+  try:
+    commands = ['/a/1/', '/a/2/', '/a/3/', '/a/4/']
+    session = libzjsn.Session('127.0.0.1', pool = libzjsn.ConnectionPool(port = server.port))
+    assert(session.pipelineCommands(commands) == [{'command': command} for command in commands])
+    assert([command for connection, command in server.requests if connection == 1] == commands[:3])
+    assert(sorted(command for connection, command in server.requests if connection != 1) == commands[2:])
+  finally:
+    server.close()
+
+def testStaleConnectionReconnects():
+  # The first two connections answer one request each and are closed by the server on the next one.
+  server = FakeServer(lambda request, connection, number:
+      None if connection < 3 and number == 2 else makeResponse({'command': commandOf(request)}))
+  try:
+    pool = libzjsn.ConnectionPool(port = server.port)
+    session = libzjsn.Session('127.0.0.1', pool = pool, retryPolicy = libzjsn.RetryPolicy(retryCount = 0))
+    assert(session.issueCommand('/a/1/') == {'command': '/a/1/'})
+    assert(session.issueCommand('/a/2/') == {'command': '/a/2/'})
+    assert(session.pipelineCommands(['/a/3/', '/a/4/']) == [{'command': '/a/3/'}, {'command': '/a/4/'}])
+    # Each request went out once on a live connection, after one on the stale one.
+    assert(server.requests == [(1, '/a/1/'), (1, '/a/2/'), (2, '/a/2/'), (2, '/a/3/'), (3, '/a/3/'), (3, '/a/4/')])
+  finally:
+    server.close()
+
+def testStreamingInflaterLimit():
+  compressed = zlib.compress(b'a' * 1000000)
+  inflater = libzjsn.StreamingInflater(1000)
+  try:
+    for i in range(0, len(compressed), 100):
+      inflater.feed(compressed[i:i + 100])
+    assert(False)
+  except libzjsn.ResponseTooLarge as e:
+    assert(e.limit == 1000)
+  # However compressible the input, no more than one byte past the limit is inflated.
+  assert(inflater.size == 1001 and len(inflater.output) == 0)
+
+def testResponseTooLargeClosesConnection():
+  server = FakeServer(lambda request, connection, number: makeResponse({'data': 'a' * 1000000}, 64))
+  try:
+    pool = libzjsn.ConnectionPool(port = server.port)
+    session = libzjsn.Session('127.0.0.1', pool = pool)
+    try:
+      session.issueCommand('/a/', maxSize = 10000)
+      assert(False)
+    except libzjsn.ResponseTooLarge:
+      pass
+    assert(len(server.requests) == 1 and not pool._idle['127.0.0.1'])
+    for i in range(100):
+      if server.closedByClient:
+        break
+      time.sleep(0.01)
+    assert(server.closedByClient == 1)
+  finally:
+    server.close()
+
+def makeClient(port, deferSleeps):
+  loginResult = (None, {'userShipVO': [], 'fleetVo': []}, {'pveLevel': [], 'pveNode': []}) + (None,) * 7
+  client = BasicClient('127.0.0.1', '127.0.0.1', 'user', 'password', loginResult = loginResult, deferSleeps = deferSleeps)
+  client._session = libzjsn.Session('127.0.0.1', pool = libzjsn.ConnectionPool(port = port))
+  return client
+
+def makeTaskVo(taskCid, finished = True):
+  return {'taskCid': str(taskCid), 'condition': [{'finishedAmount': '1' if finished else '0', 'totalAmount': '1'}]}
+
+def testDeferredTaskAwards():
+  commands = []
+  def handle(request, connection, number):
+    commands.append(commandOf(request))
+    # Collecting the award of task 1 completes task 3.
+    return makeResponse({'updateTaskVo': [makeTaskVo(3)]} if commands[-1] == '/task/getAward/1/' else {})
+  server = FakeServer(handle)
+  try:
+    client = makeClient(server.port, True)
+    client.processGenericResponse({'updateTaskVo': [makeTaskVo(1), makeTaskVo(2), makeTaskVo(4, False)]})
+    assert(commands == [] and client.completedTasks == {1, 2})
+    delays = []
+    for delay in client.taskAwardSteps():
+      # Every award is followed by a pause before the next command.
+      delays.append(delay)
+      assert(len(commands) == len(delays))
+    assert(commands == ['/task/getAward/1/', '/task/getAward/2/', '/task/getAward/3/'])
+    assert(delays == [1, 1, 1] and client.completedTasks == set())
+  finally:
+    server.close()
+
+def testCompletedTasksKeptUntilAnswered():
+  answers = {'/task/getAward/1/': None, '/task/getAward/2/': makeResponse({'eid': -1})}
+  server = FakeServer(lambda request, connection, number: answers.get(commandOf(request), makeResponse({})))
+  try:
+    client = makeClient(server.port, True)
+    client._session.retryPolicy = libzjsn.RetryPolicy(retryCount = 0)
+    client.processGenericResponse({'updateTaskVo': [makeTaskVo(1), makeTaskVo(2)]})
+    steps = client.taskAwardSteps()
+    # Without an answer the task stays completed and queued.
+    try:
+      next(steps)
+      assert(False)
+    except ConnectionError:
+      pass
+    assert(client.completedTasks == {1, 2})
+    del answers['/task/getAward/1/']
+    steps = client.taskAwardSteps()
+    assert(next(steps) == 1 and client.completedTasks == {2})
+    # The server rejecting the award means the task is gone.
+    try:
+      next(steps)
+      assert(False)
+    except libzjsn.ServerError:
+      pass
+    assert(client.completedTasks == set())
+  finally:
+    server.close()
+
+def testNodeRule():
+  generator = random.Random(1)
+  makeMatchers = [lambda: challenge_lib.AllMatcher(), lambda: EvenFleetMatcher(),
+      lambda: challenge_lib.AssertEnemyMatcher(generator.randint(1, 8)),
+      lambda: challenge_lib.EnemyFleetMatcher(generator.randint(1, 8))]
+  for i in range(500):
+    rules = [(generator.choice(makeMatchers)(), generator.randint(1, 5)) for j in range(generator.randint(0, 8))]
+    nodeRule = challenge_lib.NodeRule(rules)
+    for j in range(10):
+      enemyFleetId = generator.randint(1, 8)
+      enemyShips = [{'shipCid': str(generator.randint(1, 8))} for k in range(generator.randint(0, 6))] or None
+      assert(nodeRule.apply(enemyFleetId, enemyShips) == applyRulesLinearly(rules, enemyFleetId, enemyShips))
+
+def loadAdvFetcher():
+  '''adv-fetcher.py cannot be imported by name.'''
+  path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'adv-fetcher.py')
+  spec = importlib.util.spec_from_file_location('adv_fetcher', path)
+  module = importlib.util.module_from_spec(spec)
+  spec.loader.exec_module(module)
+  return module
+
+def makeLogEntry(logId, createTime = 1500000000):
+  return (5, logId, 200000, 'user', createTime, 10000100, 1, 400, 100, 400, 100)
+
+def testFilterNewEntries():
+  fetcher = loadAdvFetcher()
+  entries = [makeLogEntry(logId) for logId in [12, 11, 10]]
+  assert(fetcher.filterNewEntries(5, 'Boat', entries) == (entries, None))
+  newEntries, gap = fetcher.filterNewEntries(5, 'Boat', [makeLogEntry(logId) for logId in [13, 12, 11]])
+  assert([entry[1] for entry in newEntries] == [13] and gap is None)
+  # None of the entries was seen before, so some in between may have been missed.
+  newEntries, gap = fetcher.filterNewEntries(5, 'Boat', [makeLogEntry(logId) for logId in [17, 16]])
+  assert(len(newEntries) == 2 and gap == (13, 16))
+  # Until the writer commits them, only the pending mark moves.
+  assert(fetcher.highWaterMarks == {})
+  fetcher.settleHighWaterMarks([(5, 'Boat', 0, entries, None)], True)
+  assert(fetcher.highWaterMarks == {(5, 'Boat'): 12})
+  # A failed commit lets the next fetch return the lost entries again.
+  fetcher.settleHighWaterMarks([(5, 'Boat', 0, newEntries, gap)], False)
+  newEntries, gap = fetcher.filterNewEntries(5, 'Boat', [makeLogEntry(logId) for logId in [17, 16, 15, 14, 13]])
+  assert([entry[1] for entry in newEntries] == [17, 16, 15, 14, 13] and gap == (12, 13))
+  assert(fetcher.filterNewEntries(6, 'Boat', []) == ([], None))
+
+def testAdaptivePoller():
+  fetcher = loadAdvFetcher()
+  poller = fetcher.AdaptivePoller(10, minPeriod = 1, maxPeriod = 60, window = 30)
+  # 30 entries over 29 seconds: one per second, so half a window arrives in 15 seconds.
+  entries = [makeLogEntry(logId, 1500000000 + logId) for logId in range(30)]
+  assert(poller.observe(entries, 5, None) == 15)
+  assert(poller.observe(entries, 0, None) == 22.5)
+  assert(poller.observe(entries, 30, (0, 1)) == 11.25)
+  for i in range(10):
+    poller.observe(entries, 30, (0, 1))
+  assert(poller.period == 1)
+  for i in range(20):
+    poller.observe([], 0, None)
+  assert(poller.period == 60)
+
+cases = [testServerErrorKnown, testServerErrorUnknown, testMakeHTTPRequest, testParseChunkedResponse, testParseHTTPResponse,
+    testPickCookie, testSelectiveDecoder, testRetryPolicy, testCircuitBreaker, testCircuitBreakerCancelledProbe,
+    testAsyncDefaultPoolPerLoop, testAsyncRequestHooks, testSessionCacheSharedFile,
+    testPipelineReissuesLostResponses, testStaleConnectionReconnects, testStreamingInflaterLimit,
+    testResponseTooLargeClosesConnection, testDeferredTaskAwards,
+    testCompletedTasksKeptUntilAnswered, testNodeRule,
+    testFilterNewEntries, testAdaptivePoller]
+
+def runCases(cases):
+  '''Runs every case even if an earlier one failed. Returns: the number of failed cases.'''
+  failures = 0
+  for case in cases:
+    try:
+      case()
+    except Exception:
+      failures += 1
+      traceback.print_exc()
+      print('FAIL', case.__name__)
+  return failures
 
-for case in cases:
-  case()
+if __name__ == '__main__':
+  sys.exit(1 if runCases(cases) else 0)
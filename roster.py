@@ -0,0 +1,88 @@
+try:
+  import numpy
+except ImportError:
+  numpy = None
+
+class RosterView:
+  '''Ships of a BasicClient as NumPy columns, for queries over the whole roster at once.
+
+  Rows are updated in place as ships change. Every query returns an array of ship or fleet IDs.
+  Requires numpy.'''
+
+  _columns = ('id', 'hp', 'maxHp', 'level', 'exp', 'nextExp', 'fleetId')
+
+  def __init__(self, ships = (), fleets = (), capacity = 256):
+    if numpy is None:
+      raise ImportError('RosterView requires numpy')
+    self._rows = {}
+    self._size = 0
+    self._arrays = {name: numpy.zeros(capacity, dtype = numpy.int64) for name in self._columns}
+    for ship in ships:
+      self.update(ship)
+    self.setFleets(fleets)
+
+  def __len__(self):
+    return self._size
+
+  def __getattr__(self, name):
+    if name in self._columns:
+      return self._arrays[name][:self._size]
+    raise AttributeError(name)
+
+  def update(self, ship):
+    '''Adds or replaces a libzjsn.Ship.'''
+    row = self._rows.get(ship.id)
+    if row is None:
+      row = self._size
+      if row == len(self._arrays['id']):
+        self._grow()
+      self._rows[ship.id] = row
+      self._size += 1
+    arrays = self._arrays
+    arrays['id'][row] = ship.id
+    arrays['hp'][row] = ship.hp
+    arrays['maxHp'][row] = ship.maxHp
+    arrays['level'][row] = ship.level
+    arrays['exp'][row] = ship.exp
+    arrays['nextExp'][row] = ship.nextExp
+    arrays['fleetId'][row] = ship.fleetId
+
+  def setFleets(self, fleets):
+    '''Rebuilds fleet membership from libzjsn.Fleet records.'''
+    fleetIds = self._arrays['fleetId']
+    fleetIds[:] = 0
+    for fleet in fleets:
+      for shipId in fleet.shipIds:
+        row = self._rows.get(shipId)
+        if row is not None:
+          fleetIds[row] = fleet.id
+
+  def belowHpRatio(self, ratio):
+    return self.id[self.hp < self.maxHp * ratio]
+
+  def halfBroken(self):
+    '''Same criterion as libzjsn.isHalfBroken.'''
+    return self.id[self.hp * 2 < self.maxHp]
+
+  def broken(self):
+    '''Same criterion as libzjsn.isBroken.'''
+    return self.id[self.hp * 4 < self.maxHp]
+
+  def fleetsWithBrokenShips(self, halfBroken = False):
+    factor = 2 if halfBroken else 4
+    fleetIds = self.fleetId[self.hp * factor < self.maxHp]
+    return numpy.unique(fleetIds[fleetIds != 0])
+
+  def shipsInFleet(self, fleetId):
+    return self.id[self.fleetId == fleetId]
+
+  def nearLevelUp(self, expWithin):
+    '''Ships needing at most expWithin more exp to reach the next level.'''
+    remaining = self.nextExp - self.exp
+    return self.id[(self.nextExp > 0) & (remaining <= expWithin)]
+
+  def _grow(self):
+    for name, array in self._arrays.items():
+      grown = numpy.zeros(len(array) * 2, dtype = array.dtype)
+      grown[:len(array)] = array
+      self._arrays[name] = grown
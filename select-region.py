@@ -2,37 +2,38 @@
 
 from contextlib import closing
 from datetime import datetime, timezone
+from queue import Full, Queue
+from threading import Thread
 
+import bisect
 import sqlite3
 import sys
+import time
 
 def strToEopch(t):
   return (datetime.strptime(t, '%Y-%m-%dT%H-%M%z') - datetime.fromtimestamp(0, timezone.utc)).total_seconds()
 
+def destinationName(baseName, start, end):
+  return '{}.{}.{}.sqlite3'.format(baseName, start if start else '0', end if end else 'max')
+
 def selectRange(conn, baseName, tableName, schema, start, end):
   print('Processing {} to {}'.format(start, end))
-  dstName = baseName
+  dstName = destinationName(baseName, start, end)
   conditions = list()
   params = list()
   if start:
     conditions.append('time >= ?')
     params.append(strToEopch(start))
-    dstName = dstName + '.' + start
-  else:
-    dstName = dstName + '.0'
   if end:
     conditions.append('time < ?')
     params.append(strToEopch(end))
-    dstName = dstName + '.' + end
-  else:
-    dstName = dstName + '.max'
-  dstName += '.sqlite3'
   print('Generating {}'.format(dstName))
   with closing(sqlite3.connect(dstName)) as dst:
     dst.execute(schema)
   conn.execute('ATTACH DATABASE ? AS dst;', (dstName,))
   try:
     conn.execute('INSERT INTO dst.{} SELECT * FROM src.{} WHERE {};'.format(tableName, tableName, ' AND '.join(conditions)), tuple(params))
+    conn.commit()
     count, first, last = conn.execute(
         'SELECT COUNT(*), datetime(MIN(time), "unixepoch", "localtime"), datetime(MAX(time), "unixepoch", "localtime") FROM dst.{}'.format(
             tableName)).fetchone()
@@ -40,20 +41,100 @@ def selectRange(conn, baseName, tableName, schema, start, end):
   finally:
     conn.execute('DETACH DATABASE dst;')
 
-if len(sys.argv) != 5:
-  sys.stderr.write('Usage: {} baseDb baseName tableName timePoints\n'.format(sys.argv[0]))
+def writeDestinationJob(dstName, tableName, schema, queue, counts, errors, index):
+  '''Writes row batches from queue until None. On error the exception is left in errors[index] and the
+  queue is still drained, so the scanning thread never blocks on it.'''
+  finished = False
+  try:
+    with closing(sqlite3.connect(dstName)) as dst:
+      dst.execute('PRAGMA synchronous = OFF;')
+      dst.execute(schema)
+      with dst:
+        while True:
+          rows = queue.get()
+          if rows is None:
+            finished = True
+            break
+          dst.executemany('INSERT INTO {} VALUES ({});'.format(tableName, ','.join('?' * len(rows[0]))), rows)
+          counts[index] += len(rows)
+  except Exception as e:
+    errors[index] = e
+    while not finished:
+      finished = queue.get() is None
+
+def putWhileAlive(queue, item, thread):
+  '''Returns: False if thread died before taking item.'''
+  while thread.is_alive():
+    try:
+      queue.put(item, timeout = 1)
+      return True
+    except Full:
+      pass
+  return False
+
+def selectRangesSinglePass(conn, baseName, tableName, schema, ranges, batchSize = 10000):
+  '''Splits the source table into all ranges with one ordered scan over an index on time.'''
+  print('Indexing {} by time'.format(tableName))
+  conn.execute('CREATE INDEX IF NOT EXISTS src.{}_time ON {} (time);'.format(tableName, tableName))
+  lowerBound = strToEopch(ranges[0][0])
+  upperBounds = [strToEopch(end) for start, end in ranges[:-1]]
+
+  queues = []
+  threads = []
+  counts = [0] * len(ranges)
+  errors = [None] * len(ranges)
+  for i, (start, end) in enumerate(ranges):
+    dstName = destinationName(baseName, start, end)
+    print('Generating {}'.format(dstName))
+    queues.append(Queue(16))
+    threads.append(Thread(target = writeDestinationJob, name = dstName,
+        args = (dstName, tableName, schema, queues[i], counts, errors, i)))
+    threads[i].start()
+
+  startTime = time.monotonic()
+  try:
+    cursor = conn.execute('SELECT * FROM src.{} WHERE time >= ? ORDER BY time;'.format(tableName), (lowerBound,))
+    timeColumn = [column[0].lower() for column in cursor.description].index('time')
+    while True:
+      rows = cursor.fetchmany(batchSize)
+      if not rows:
+        break
+      batches = {}
+      for row in rows:
+        batches.setdefault(bisect.bisect_right(upperBounds, row[timeColumn]), []).append(row)
+      for i, batch in batches.items():
+        if errors[i] is not None or not putWhileAlive(queues[i], batch, threads[i]):
+          raise RuntimeError('Writing {} failed'.format(threads[i].name)) from errors[i]
+  finally:
+    for queue, thread in zip(queues, threads):
+      putWhileAlive(queue, None, thread)
+    for thread in threads:
+      thread.join()
+  for thread, error in zip(threads, errors):
+    if error is not None:
+      raise RuntimeError('Writing {} failed'.format(thread.name)) from error
+  elapsed = time.monotonic() - startTime
+  for (start, end), count in zip(ranges, counts):
+    print('{} records from {} to {}'.format(count, start, end))
+  total = sum(counts)
+  print('{} records in {:.1f}s, {:.0f} rows/s'.format(total, elapsed, total / elapsed if elapsed else 0))
+
+if len(sys.argv) not in (5, 6) or (len(sys.argv) == 6 and sys.argv[5] != '--single-pass'):
+  sys.stderr.write('Usage: {} baseDb baseName tableName timePoints [--single-pass]\n'.format(sys.argv[0]))
   exit(1)
 
 baseDb = sys.argv[1]
 baseName = sys.argv[2]
 tableName = sys.argv[3]
 timePoints = sys.argv[4]
+singlePass = len(sys.argv) == 6
 
 conn = sqlite3.connect(':memory:')
 conn.execute('ATTACH DATABASE ? AS src;', (baseDb,))
 conn.execute('PRAGMA busy_timeout = 1200000;')
 schema = conn.execute('SELECT sql FROM src.SQLITE_MASTER WHERE type = "table" AND tbl_name = ?', (tableName,)).fetchone()[0]
 print(schema)
+ranges = list()
 start = None
 end = None
 for line in open(timePoints, 'r', encoding = 'UTF-8'):
@@ -63,7 +144,12 @@ for line in open(timePoints, 'r', encoding = 'UTF-8'):
   start = end
   end = line
   if start:
-    selectRange(conn, baseName, tableName, schema, start, end)
+    ranges.append((start, end))
 start = end
 end = None
-selectRange(conn, baseName, tableName, schema, start, end)
+ranges.append((start, end))
+if singlePass:
+  selectRangesSinglePass(conn, baseName, tableName, schema, ranges)
+else:
+  for start, end in ranges:
+    selectRange(conn, baseName, tableName, schema, start, end)